@@ -7,19 +7,15 @@ Keithley SMU client
 import argparse
 import json
 import os
+import time
 
-import PyQt5
-import pyqtgraph as pg
 from platformdirs import user_data_dir
-from PyQt5.QtGui import QFont
-from PyQt5.QtWidgets import QApplication
 
-from .config import CONFIGS
-from .gui.MainWindow import MainWindow
+from .config import CONFIGS, KEITHLEY_ADDRESS, STREAM_MAX_SAMPLES
 
 __version__ = "0.6.0"
 __author__ = "Fabio T"
-__all__ = ["PyQt5"]
+__all__ = ["cli"]
 
 win_title = f"Keithley SMU client {__version__} - {__author__}"
 
@@ -37,19 +33,173 @@ def config_pyqtgraph():
     """
     PyQtGraph configuration
     """
+    import pyqtgraph as pg
+
     pg.setConfigOption("antialias", True)
     pg.setConfigOption("background", "w")
     pg.setConfigOption("foreground", "k")
     pg.setConfigOption("leftButtonPan", False)
 
 
+def add_dummy_arguments(parser):
+    """
+    Options of the dummy Keithley, see `dummy_options`
+    """
+    parser.add_argument(
+        "--dummy-interface",
+        choices=["none", "gpib", "usb", "lan"],
+        help="bus latency emulated by the dummy (default: from the address)",
+    )
+    parser.add_argument(
+        "--dummy-latency",
+        nargs=2,
+        type=float,
+        metavar=("MEAN", "JITTER"),
+        help="latency (s) of the writes and queries of the dummy",
+    )
+    parser.add_argument(
+        "--dummy-seed", type=int, help="seed of the dummy noise and jitter"
+    )
+
+
+def dummy_options(args):
+    """
+    Arguments of `KeithleyDummy` given on the command line
+    """
+    options = {
+        "interface": args.dummy_interface,
+        "latency": args.dummy_latency,
+        "seed": args.dummy_seed,
+    }
+    return {k: v for k, v in options.items() if v is not None}
+
+
+def run(args):
+    """
+    Record a measurement without the GUI
+    """
+    from .controller.engine import (
+        AcquisitionEngine,
+        check_settings,
+        load_recipe,
+        measurement_settings,
+        saving_columns,
+    )
+
+    cfg = load_recipe(args.config, args.mode) if args.config else CONFIGS[args.mode]
+    settings = measurement_settings(cfg)
+    try:
+        check_settings(**settings)
+    except ValueError as e:
+        raise SystemExit(f"Invalid settings: {e}")
+
+    engine = AcquisitionEngine(
+        args.address,
+        dummy=args.dummy,
+        reset=not args.attach,
+        transcript=args.record,
+        verify=args.verify,
+        dummy_options=dummy_options(args),
+    )
+    server = None
+    try:
+        if args.metrics_port is not None:
+            from .controller.metrics import MetricsServer
+
+            server = MetricsServer(engine.loop_metrics, args.metrics_port)
+            print(f"Metrics published on {server.address}")
+
+        # The samples are streamed to the output file, so that nothing is lost
+        # if the run is interrupted
+        start = time.monotonic()
+        n = 0
+        try:
+            for samples in engine.iter_samples(
+                **settings,
+                max_samples=STREAM_MAX_SAMPLES,
+                stream=(args.out, saving_columns(cfg)),
+            ):
+                n += len(samples["Time"])
+                print(f"\r{n} samples", end="", flush=True)
+                if args.duration and time.monotonic() - start >= args.duration:
+                    break
+        except KeyboardInterrupt:
+            pass
+        engine.wait()
+        print(f"\r{n} samples saved to {args.out}")
+        if args.stats:
+            engine.keithley.stats.dump(args.stats)
+    finally:
+        if server is not None:
+            server.close()
+        # closes the session, and the transcript being recorded
+        engine.close()
+
+
+def simulate(args):
+    """
+    Run the instrument simulator
+    """
+    from .controller.simulator import serve
+
+    try:
+        serve(args.host, args.port, args.interface, args.seed)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+
+def gui(args):
+    """
+    Show the main window
+    """
+    from PyQt5.QtGui import QFont
+    from PyQt5.QtWidgets import QApplication
+
+    from .gui.MainWindow import MainWindow
+
+    config_pyqtgraph()
+
+    # Create the application
+    app = QApplication([])
+    app.setFont(QFont("Arial", args.font_size))
+    if args.idvg:
+        mode = "Id-Vg"
+    elif args.idvd:
+        mode = "Id-Vd"
+    elif args.time:
+        mode = "Time"
+    elif args.pulse:
+        mode = "Time (pulse)"
+    else:
+        mode = "Id-Vd"
+
+    # Create the main window
+    main = MainWindow(
+        win_title,
+        mode,
+        args.dummy,
+        reset=not args.attach,
+        process=args.process,
+        transcript=args.record,
+        metrics_port=args.metrics_port,
+        verify=args.verify,
+        dummy_options=dummy_options(args),
+    )
+    main.show()
+
+    # Run the application
+    app.exec_()
+
+
 def cli():
     """
     # Command line interface
 
     ## Usage
 
-    `keithley_client [--idvd] [--idvg] [--time] [--font-size N] [--dummy] [--version] [--help]`
+    `keithley_client [--idvd] [--idvg] [--time] [--font-size N] [--dummy] [--dummy-interface {none,gpib,usb,lan}] [--dummy-latency MEAN JITTER] [--dummy-seed N] [--attach] [--process] [--record FILE] [--verify] [--metrics-port PORT] [--version] [--help]`
+
+    `keithley_client run [--mode MODE] [--config RECIPE] --out FILE [--duration S] [--address ADDRESS] [--dummy] [--dummy-interface {none,gpib,usb,lan}] [--dummy-latency MEAN JITTER] [--dummy-seed N] [--attach] [--record FILE] [--verify] [--stats FILE] [--metrics-port PORT]`
 
     ## Options
 
@@ -65,9 +215,45 @@ def cli():
 
     `--dummy`: use a dummy Keithley class to test the application
 
+    `--dummy-interface`, `--dummy-latency`, `--dummy-seed`: bus latency
+    (interface preset, or mean and jitter in s of the writes and queries)
+    and seed of the noise and jitter of the dummy, to benchmark the
+    acquisition
+
+    `--attach`: connect to the instrument without resetting it
+
+    `--process`: run the acquisition in a separate process, so that the
+    plots do not delay the measurements
+
+    `--record`: record the VISA calls and their timings to a transcript file
+    (JSON lines, gzip compressed if it ends with .gz)
+
+    `--verify`: read the source levels back from the instrument instead of
+    using the values sent (slower, extra queries for each reading)
+
+    `--metrics-port`: publish the acquisition loop metrics (sample rate,
+    jitter, backlog...) in the Prometheus text format on
+    http://127.0.0.1:PORT/metrics
+
     `--font-size`: set the font size of the application
 
     `--version`: show the version of the program
+
+    `keithley_client simulate [--host HOST] [--port PORT] [--interface {none,gpib,usb,lan}] [--seed N]`
+
+    `run` records a measurement without the GUI (PyQt5 is not loaded). The
+    mode configuration can be changed with a TOML recipe using the same keys,
+    the samples are streamed to the output file.
+
+    `--stats` writes the latency, bytes and count of the instrument calls of
+    the run, per command type, to a JSON file.
+
+    `--address REPLAY::FILE` replays a transcript at the original speed,
+    `REPLAY::FILE::FAST` as fast as possible.
+
+    `simulate` runs a simulated instrument speaking TSP on a local TCP socket,
+    use it with `--address TCPIP::127.0.0.1::5025::SOCKET`. It executes the
+    commands it receives, so it only listens on a loopback address.
     """
 
     parser = argparse.ArgumentParser(description="Keithley SMU client")
@@ -88,6 +274,31 @@ def cli():
         action="store_true",
         help="use a dummy Keithley class to test the application",
     )
+    add_dummy_arguments(parser)
+    parser.add_argument(
+        "--attach",
+        action="store_true",
+        help="connect to the instrument without resetting it",
+    )
+    parser.add_argument(
+        "--process",
+        action="store_true",
+        help="run the acquisition in a separate process",
+    )
+    parser.add_argument(
+        "--record", metavar="FILE", help="record the VISA calls to a transcript"
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="read the source levels back from the instrument",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        metavar="PORT",
+        help="publish the loop metrics for Prometheus on localhost",
+    )
     parser.add_argument(
         "--font-size",
         type=int,
@@ -100,27 +311,88 @@ def cli():
         action="version",
         version=f"%(prog)s {__version__}",
     )
+    subparsers = parser.add_subparsers(dest="command")
+    run_parser = subparsers.add_parser(
+        "run", help="record a measurement without the GUI"
+    )
+    run_parser.add_argument(
+        "--mode",
+        choices=list(CONFIGS),
+        default="Id-Vd",
+        help="measurement mode",
+    )
+    run_parser.add_argument(
+        "--config", help="TOML recipe overriding the mode configuration"
+    )
+    run_parser.add_argument(
+        "--out",
+        required=True,
+        help="output file, binary if it ends with .bin, TSV otherwise",
+    )
+    run_parser.add_argument(
+        "--duration",
+        type=float,
+        help="stop after this time (s), for the time modes",
+    )
+    run_parser.add_argument(
+        "--address", default=KEITHLEY_ADDRESS, help="VISA address of the instrument"
+    )
+    run_parser.add_argument(
+        "--dummy",
+        action="store_true",
+        help="use a dummy Keithley class",
+    )
+    add_dummy_arguments(run_parser)
+    run_parser.add_argument(
+        "--attach",
+        action="store_true",
+        help="connect to the instrument without resetting it",
+    )
+    run_parser.add_argument(
+        "--record", metavar="FILE", help="record the VISA calls to a transcript"
+    )
+    run_parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="read the source levels back from the instrument",
+    )
+    run_parser.add_argument(
+        "--stats", metavar="FILE", help="save the command timing to a JSON file"
+    )
+    run_parser.add_argument(
+        "--metrics-port",
+        type=int,
+        metavar="PORT",
+        help="publish the loop metrics for Prometheus on localhost",
+    )
+    simulate_parser = subparsers.add_parser(
+        "simulate", help="run a simulated instrument on a local TCP socket"
+    )
+    simulate_parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="loopback address (the simulator executes the commands it receives)",
+    )
+    simulate_parser.add_argument("--port", type=int, default=5025, help="TCP port")
+    simulate_parser.add_argument(
+        "--interface",
+        choices=["none", "gpib", "usb", "lan"],
+        default="none",
+        help="bus latency to emulate",
+    )
+    simulate_parser.add_argument(
+        "--seed", type=int, help="seed of the measurement noise"
+    )
     args = parser.parse_args()
+    if args.record and args.dummy:
+        # the dummy makes no VISA calls
+        parser.error("--record needs an instrument, it cannot be used with --dummy")
+    if args.command != "simulate" and dummy_options(args) and not args.dummy:
+        parser.error("the --dummy-* options need --dummy")
 
-    config_pyqtgraph()
-
-    # Create the application
-    app = QApplication([])
-    app.setFont(QFont("Arial", args.font_size))
-    if args.idvg:
-        mode = "Id-Vg"
-    elif args.idvd:
-        mode = "Id-Vd"
-    elif args.time:
-        mode = "Time"
-    elif args.pulse:
-        mode = "Time (pulse)"
+    if args.command == "run":
+        run(args)
+    elif args.command == "simulate":
+        simulate(args)
     else:
-        mode = "Id-Vd"
-
-    # Create the main window
-    main = MainWindow(win_title, mode, args.dummy)
-    main.show()
-
-    # Run the application
-    app.exec_()
+        gui(args)
@@ -4,6 +4,41 @@ Configuration file for the Keithley client.
 
 KEITHLEY_ADDRESS = "GPIB0::26::INSTR"
 
+# Samples kept in memory while streaming the data to a file
+STREAM_MAX_SAMPLES = 100_000
+
+# Speed/accuracy presets of the measurement, applied to both SMUs
+# - nplc: integration time in power line cycles
+# - autozero: "OFF", "ONCE" or "AUTO"
+# - autorange: autorange the current, down to lowrangei, or use the fixed rangei
+# - delay: measure delay (s), -1 for the automatic delay
+SPEED_PROFILES = {
+    "Fast": {
+        "nplc": 0.01,
+        "autozero": "OFF",
+        "autorange": False,
+        "rangei": 1e-4,
+        "lowrangei": 1e-6,
+        "delay": 0,
+    },
+    "Normal": {
+        "nplc": 1,
+        "autozero": "AUTO",
+        "autorange": True,
+        "rangei": 1e-4,
+        "lowrangei": 1e-6,
+        "delay": -1,
+    },
+    "Hi-accuracy": {
+        "nplc": 10,
+        "autozero": "AUTO",
+        "autorange": True,
+        "rangei": 1e-4,
+        "lowrangei": 1e-9,
+        "delay": -1,
+    },
+}
+
 CONFIGS = {
     "Id-Vd": {
         "Vg": {
@@ -42,9 +77,13 @@ CONFIGS = {
             "Vd": True,
             "Id": True,
             "Ig": True,
+            "Host time": False,
+            "Stream": False,
         },
         "period": 0.100,
         "n_points": 1,
+        "instrument_sweep": True,
+        "profile": "Normal",
     },
     "Id-Vg": {
         "Vg": {
@@ -83,9 +122,13 @@ CONFIGS = {
             "Vd": True,
             "Id": True,
             "Ig": True,
+            "Host time": False,
+            "Stream": False,
         },
         "period": 0.100,
         "n_points": 1,
+        "instrument_sweep": True,
+        "profile": "Normal",
     },
     "Time": {
         "Vg": {
@@ -124,9 +167,13 @@ CONFIGS = {
             "Vd": True,
             "Id": True,
             "Ig": True,
+            "Host time": False,
+            "Stream": False,
         },
         "period": 0.100,
         "n_points": 1,
+        "instrument_sweep": True,
+        "profile": "Normal",
     },
     "Time (pulse)": {
         "Vg": {
@@ -165,8 +212,12 @@ CONFIGS = {
             "Vd": True,
             "Id": True,
             "Ig": True,
+            "Host time": False,
+            "Stream": False,
         },
-        "period": 0.100,
+        "period": 2.5,
         "n_points": 1,
+        "instrument_sweep": True,
+        "profile": "Normal",
     },
 }
@@ -0,0 +1,98 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+from .keithley import Keithley
+from .keithley_dummy import KeithleyDummy
+
+# Blocking VISA calls of every instrument run here, so the event loop never
+# waits on the bus
+executor = ThreadPoolExecutor(thread_name_prefix="keithley-io")
+
+
+class AsyncKeithley:
+    """
+    asyncio wrapper of the Keithley driver
+
+    Every method of the wrapped driver is available as a coroutine, except
+    `batch` which is an async context manager. Calls to the same instrument
+    are serialized by a lock, calls to different instruments run
+    concurrently in the shared executor.
+    """
+
+    def __init__(self, keithley):
+        self.keithley = keithley
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, address, dummy=False, **kwargs):
+        """
+        Connect to the instrument at `address` without blocking the event loop
+        """
+        driver = KeithleyDummy if dummy else Keithley
+        loop = asyncio.get_running_loop()
+        keithley = await loop.run_in_executor(
+            executor, partial(driver, address, **kwargs)
+        )
+        return cls(keithley)
+
+    async def run(self, func, *args):
+        """
+        Run `func(keithley, *args)` in the executor holding the instrument lock
+
+        Use it for sequences that must not be interleaved with other calls,
+        e.g. statements sent together with `keithley.batch()`.
+        """
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                executor, partial(func, self.keithley, *args)
+            )
+
+    @asynccontextmanager
+    async def batch(self):
+        """
+        Send the calls made in the block together, in one executor call:
+
+            async with keithley.batch() as batch:
+                batch.turn_output_on("b")
+                batch.turn_output_on("a")
+
+        The driver methods of `batch` only queue the calls, which are sent
+        when the block ends without an exception.
+        """
+        batch = BatchCalls()
+        yield batch
+
+        def send(keithley):
+            with keithley.batch():
+                for name, args, kwargs in batch.calls:
+                    getattr(keithley, name)(*args, **kwargs)
+
+        await self.run(send)
+
+    def __getattr__(self, name):
+        attr = getattr(self.keithley, name)
+        if not callable(attr):
+            return attr
+
+        async def method(*args, **kwargs):
+            return await self.run(lambda keithley: attr(*args, **kwargs))
+
+        return method
+
+
+class BatchCalls:
+    """
+    Driver calls queued by `AsyncKeithley.batch`
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+
+        return call
@@ -0,0 +1,360 @@
+import asyncio
+import time
+
+import numpy as np
+import pandas
+
+from .async_keithley import AsyncKeithley
+from .buffer import ColumnStore
+from .engine import AcquisitionEngine, PeriodicScheduler, check_settings
+from .transcript import TranscriptMismatch
+
+
+def qt_event_loop(app):
+    """
+    Run asyncio on top of the Qt event loop of `app` (requires qasync)
+    """
+    import qasync
+
+    loop = qasync.QEventLoop(app)
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+class AsyncRecorder:
+    """
+    asyncio acquisition loop over an `AsyncKeithley`, the counterpart of
+    `AcquisitionEngine` without a thread per instrument
+
+    Several recorders (one per instrument) run concurrently as tasks of the
+    same event loop, the instrument calls share the executor of
+    `AsyncKeithley`. `on_data` is called after new samples and `on_end` when
+    the measurement ends, both in the event loop.
+    """
+
+    SWEEP_POLL_INTERVAL = AcquisitionEngine.SWEEP_POLL_INTERVAL
+    PULSE_BLOCK = AcquisitionEngine.PULSE_BLOCK
+    SCHEDULER_POLICY = AcquisitionEngine.SCHEDULER_POLICY
+    COLUMNS = AcquisitionEngine.COLUMNS
+
+    def __init__(self, keithley, on_data=None, on_end=None):
+        self.keithley = keithley
+        self.on_data = on_data
+        self.on_end = on_end
+        self.points = []
+        self.data = ColumnStore(self.COLUMNS)
+        self.recording = False
+        self.stopping = asyncio.Event()
+        self.pulse_info = [{"enabled": False}, {"enabled": False}]
+        self.scheduler = None
+        self.task = None
+        # exception that ended the last measurement, raised by `wait`
+        self.error = None
+
+    @classmethod
+    async def open(cls, address, dummy=False, on_data=None, on_end=None, **kwargs):
+        """
+        Connect to the instrument at `address` without blocking the event
+        loop, `kwargs` are passed to the driver
+        """
+        return cls(await AsyncKeithley.open(address, dummy, **kwargs), on_data, on_end)
+
+    async def start(
+        self,
+        points,
+        delay=1,
+        n_points=1,
+        pulse_info=None,
+        instrument_sweep=True,
+        profile=None,
+        max_samples=None,
+    ):
+        """
+        Configure the instrument and start recording in a task of the event
+        loop, see `AcquisitionEngine.start`
+        """
+        check_settings(points, delay, n_points, pulse_info, instrument_sweep, profile)
+
+        def setup(keithley):
+            keithley.stats.reset()
+            keithley.configure({"profile": profile, "n_points": n_points})
+            with keithley.batch():
+                keithley.set_source_function("b", "OUTPUT_DCVOLTS")
+                keithley.set_source_function("a", "OUTPUT_DCVOLTS")
+                if len(points):
+                    keithley.set_voltage_source("b", points[0][0])
+                    keithley.set_voltage_source("a", points[0][1])
+                keithley.turn_output_on("b")
+                keithley.turn_output_on("a")
+
+        await self.keithley.run(setup)
+
+        self.points = points
+        self.delay = delay
+        self.n_points = n_points
+        self.instrument_sweep = instrument_sweep
+        self.data = ColumnStore(self.COLUMNS, max_length=max_samples)
+        if pulse_info is not None:
+            self.pulse_info = pulse_info
+        else:
+            self.pulse_info = [{"enabled": False}, {"enabled": False}]
+
+        self.recording = True
+        self.error = None
+        self.stopping.clear()
+        self.task = asyncio.create_task(self.record())
+
+    async def wait(self):
+        """
+        Wait for the end of the measurement, raises the exception that ended
+        it, if any
+        """
+        if self.task is not None:
+            await self.task
+        if self.error is not None:
+            raise self.error
+
+    async def run(self, *args, **kwargs):
+        """
+        Record a whole measurement (arguments of `start`)
+        """
+        await self.start(*args, **kwargs)
+        await self.wait()
+
+    def notify(self, callback):
+        if callback is not None:
+            callback()
+
+    async def record(self):
+        self.data.clear()
+        self.scheduler = None
+        await self.keithley.reset_clock()
+        self.start_ns = time.perf_counter_ns()
+
+        try:
+            await self.acquire()
+        except TranscriptMismatch as e:
+            print(f"End of the replay: {e}")
+        except Exception as e:
+            # e.g. a VISA timeout or a dropped link, raised by `wait`
+            self.error = e
+            try:
+                await self.turn_outputs_off()
+            except Exception as e:
+                print(f"Outputs not turned off after {self.error!r}: {e}")
+        finally:
+            self.recording = False
+            self.notify(self.on_data)
+            self.notify(self.on_end)
+
+    async def set_levels(self, vd=None, vg=None):
+        def set_levels(keithley):
+            with keithley.batch():
+                if vd is not None:
+                    keithley.set_voltage_source("a", vd)
+                if vg is not None:
+                    keithley.set_voltage_source("b", vg)
+
+        await self.keithley.run(set_levels)
+
+    async def measure(self):
+        def measure(keithley):
+            Id, Ig, t = keithley.measure_sync()
+            return t, keithley.source_v_level("a"), keithley.source_v_level("b"), Id, Ig
+
+        t, vd, vg, Id, Ig = await self.keithley.run(measure)
+        self.add_samples(
+            {
+                "Time": [t],
+                "Host time": [self.host_time_now()],
+                "Vd": [vd],
+                "Vg": [vg],
+                "Id": [Id],
+                "Ig": [Ig],
+            }
+        )
+
+    async def acquire(self):
+        """
+        Run the measurement until its end or until the recording is stopped,
+        as `AcquisitionEngine.acquire`
+        """
+        if len(self.points) == 1:
+            [vg_base, vd_base] = self.points[0]
+            vg_pulse, vd_pulse = self.pulse_info
+            vg_pulse_enabled = vg_pulse.get("enabled", False)
+            vd_pulse_enabled = vd_pulse.get("enabled", False)
+            pulsing = vg_pulse_enabled or vd_pulse_enabled
+            if pulsing:
+                pulse_delay = (
+                    vg_pulse["delay"] if vg_pulse_enabled else vd_pulse["delay"]
+                )
+                delta = [
+                    vg_pulse["delta"] if vg_pulse_enabled else 0,
+                    vd_pulse["delta"] if vd_pulse_enabled else 0,
+                ]
+
+            if self.instrument_sweep and pulsing:
+                # Pulse trains timed by the instrument
+                points = [[vg_base + delta[0], vd_base + delta[1]]] * self.PULSE_BLOCK
+                while self.recording:
+                    block_start = self.host_time_now()
+                    await self.keithley.start_pulse_train(
+                        [vg_base, vd_base],
+                        delta,
+                        pulse_delay,
+                        pulse_delay,
+                        self.delay,
+                        self.PULSE_BLOCK,
+                    )
+                    await self.read_buffered(points, block_start + 2 * pulse_delay)
+
+            else:
+                self.scheduler = PeriodicScheduler(self.delay, self.SCHEDULER_POLICY)
+                while self.recording:
+                    await self.set_levels(vd_base, vg_base)
+                    if pulsing:
+                        await self.sleep(pulse_delay)
+                        await self.set_levels(
+                            vd_base + delta[1] if vd_pulse_enabled else None,
+                            vg_base + delta[0] if vg_pulse_enabled else None,
+                        )
+                        await self.sleep(pulse_delay)
+
+                    await self.measure()
+                    if pulsing:
+                        await self.set_levels(
+                            vd_base if vd_pulse_enabled else None,
+                            vg_base if vg_pulse_enabled else None,
+                        )
+
+                    deadline = self.scheduler.next_deadline()
+                    await self.sleep(deadline - time.perf_counter())
+                    self.scheduler.tick(deadline)
+
+        elif self.instrument_sweep:
+            # Sweep run by the instrument
+            await self.keithley.start_sweep(self.points, self.delay)
+            await self.read_buffered(self.points, self.delay)
+
+        else:
+            # Standard sweep measurement
+            for [vg, vd] in self.points:
+                if not self.recording:
+                    break
+                await self.set_levels(vd, vg)
+                await self.sleep(self.delay)
+                host_time = self.host_time_now()
+                self.add_samples(
+                    {
+                        "Time": [host_time],
+                        "Host time": [host_time],
+                        "Vg": [vg],
+                        "Vd": [vd],
+                        "Id": [await self.keithley.measure_i("a")],
+                        "Ig": [await self.keithley.measure_i("b")],
+                    }
+                )
+
+    async def read_buffered(self, points, first_time):
+        """
+        Read in chunks the results of a sweep (or pulse train) run by the
+        instrument, see `AcquisitionEngine.read_buffered` (the Host time is
+        the time of the chunk)
+        """
+        n_read = 0
+        t0 = None
+        while self.recording and n_read < len(points):
+            await self.sleep(self.SWEEP_POLL_INTERVAL)
+            n = await self.keithley.sweep_count()
+            if n == n_read:
+                continue
+            t, Id, Ig = await self.keithley.read_sweep(n_read + 1, n)
+            if t0 is None:
+                t0 = t[0] - first_time
+            self.add_samples(
+                {
+                    "Time": t - t0,
+                    "Host time": np.full(len(t), self.host_time_now()),
+                    "Vg": [p[0] for p in points[n_read:n]],
+                    "Vd": [p[1] for p in points[n_read:n]],
+                    "Id": Id,
+                    "Ig": Ig,
+                }
+            )
+            n_read = n
+        if n_read < len(points):
+            await self.keithley.abort_sweep()
+
+    async def sleep(self, seconds):
+        """
+        Sleep in the recording task, until `stop` is called at most
+        """
+        if seconds <= 0:
+            return
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def add_samples(self, values):
+        self.data.extend(values)
+        self.notify(self.on_data)
+
+    def host_time_now(self):
+        """
+        Host monotonic time (s) since the start of the recording
+        """
+        return (time.perf_counter_ns() - self.start_ns) / 1e9
+
+    @property
+    def time(self):
+        return self.data["Time"]
+
+    @property
+    def host_time(self):
+        return self.data["Host time"]
+
+    @property
+    def vg(self):
+        return self.data["Vg"]
+
+    @property
+    def vd(self):
+        return self.data["Vd"]
+
+    @property
+    def id(self):
+        return self.data["Id"]
+
+    @property
+    def ig(self):
+        return self.data["Ig"]
+
+    async def turn_outputs_off(self):
+        async with self.keithley.batch() as batch:
+            batch.turn_output_off("b")
+            batch.turn_output_off("a")
+
+    async def stop(self):
+        """
+        Stop the recording and turn the outputs off, once the recording task
+        has ended
+        """
+        self.recording = False
+        self.stopping.set()
+        if self.task is not None and self.task is not asyncio.current_task():
+            await asyncio.gather(self.task, return_exceptions=True)
+        # after an error, the recording task has already tried
+        if self.error is None:
+            await self.turn_outputs_off()
+
+    async def close(self):
+        await self.keithley.close()
+
+    def save(self, filename, columns=None):
+        if columns is None:
+            columns = ["Time", "Vg", "Vd", "Id", "Ig"]
+        df = pandas.DataFrame(dict(zip(columns, self.data.view(*columns))))
+        df.to_csv(filename, index=False, sep="\t")
+        return df
@@ -0,0 +1,96 @@
+import numpy as np
+
+
+class ColumnStore:
+    """
+    Columns of samples stored in preallocated float64 NumPy arrays
+
+    The arrays grow by doubling their capacity. With `max_length` the store
+    is a ring keeping only the last `max_length` samples: every sample is
+    written twice, at i and i + max_length, so that the last samples are
+    always contiguous. Columns are returned as views, without copies.
+    """
+
+    def __init__(self, columns, capacity=1024, max_length=None):
+        self.columns = list(columns)
+        self.index = {name: i for i, name in enumerate(self.columns)}
+        self.max_length = max_length
+        self.initial_capacity = capacity
+        self.clear()
+
+    def clear(self):
+        if self.max_length is not None:
+            capacity = 2 * self.max_length
+        else:
+            capacity = self.initial_capacity
+        self.data = np.empty((len(self.columns), capacity))
+        self.start = 0
+        self.length = 0
+        # samples appended since the last clear, including the ones dropped
+        # by the ring
+        self.total = 0
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, name):
+        return self.data[self.index[name], self.start : self.start + self.length]
+
+    def view(self, *names):
+        """
+        Views of the columns `names`, all with the same length even if
+        samples are being appended by another thread
+        """
+        data, start, length = self.data, self.start, self.length
+        return [data[self.index[name], start : start + length] for name in names]
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def reserve(self, n):
+        """
+        Make room for `n` more samples
+        """
+        if self.max_length is not None:
+            return
+        capacity = self.data.shape[1]
+        if self.length + n <= capacity:
+            return
+        while capacity < self.length + n:
+            capacity *= 2
+        data = np.empty((len(self.columns), capacity))
+        data[:, : self.length] = self.data[:, : self.length]
+        self.data = data
+
+    def append(self, values):
+        """
+        Append one sample, `values` maps the column names to their values
+        """
+        self.extend({name: [value] for name, value in values.items()})
+
+    def extend(self, values):
+        """
+        Append several samples, `values` maps the column names to sequences
+        of the same length
+        """
+        n = len(next(iter(values.values())))
+        if n == 0:
+            return
+        if self.max_length is None:
+            self.reserve(n)
+            for name, column in values.items():
+                self.data[self.index[name], self.length : self.length + n] = column
+            self.length += n
+        else:
+            # sample g is stored at g % max_length and g % max_length +
+            # max_length, only the last max_length new samples are kept
+            m = min(n, self.max_length)
+            idx = (self.total + n - m + np.arange(m)) % self.max_length
+            for name, column in values.items():
+                column = np.asarray(column, dtype=float)[-m:]
+                self.data[self.index[name], idx] = column
+                self.data[self.index[name], idx + self.max_length] = column
+            self.length = min(self.length + n, self.max_length)
+            self.start = (self.total + n - self.length) % self.max_length
+        self.total += n
@@ -0,0 +1,681 @@
+import copy
+import queue
+import threading
+import time
+
+import numpy as np
+import pandas
+import toml
+
+from ..config import CONFIGS, SPEED_PROFILES
+from .buffer import ColumnStore
+from .keithley import Keithley, check_pulse_timing, integration_time
+from .keithley_dummy import KeithleyDummy
+from .metrics import LoopMetrics
+from .stream import StreamWriter
+from .transcript import TranscriptMismatch
+
+
+def load_recipe(filename, mode):
+    """
+    Configuration of `mode` with the values of the TOML recipe `filename`
+
+    The recipe uses the keys of the mode configuration (see `CONFIGS`), e.g.
+    `period = 0.5` or `[Vg.sweep]` with `start`, `stop` and `steps`.
+    """
+    cfg = copy.deepcopy(CONFIGS[mode])
+
+    def update(config, values, path):
+        for key, value in values.items():
+            if key not in config:
+                raise KeyError(f"Unknown recipe key: {path}{key}")
+            if isinstance(config[key], dict):
+                update(config[key], value, f"{path}{key}.")
+            else:
+                config[key] = value
+
+    update(cfg, toml.load(filename), "")
+    return cfg
+
+
+def build_points(cfg):
+    """
+    List of the [vg, vd] points of the measurement described by the mode
+    configuration `cfg`
+    """
+    temp = []
+    for source in ["Vg", "Vd"]:
+        if cfg[source]["mode"] == "Sweep":
+            sweep = cfg[source]["sweep"]
+            temp.append(np.linspace(sweep["start"], sweep["stop"], sweep["steps"]))
+            if sweep["bidirectional"]:
+                temp[-1] = np.concatenate([temp[-1], temp[-1][::-1]])
+        else:
+            temp.append([cfg[source]["fixed"]["value"]])
+
+    return [[vg, vd] for vg in temp[0] for vd in temp[1]]
+
+
+def build_pulse_info(cfg):
+    """
+    Pulse information of Vg and Vd for the mode configuration `cfg`
+    """
+    pulse_info = []
+    for source in ["Vg", "Vd"]:
+        if cfg[source]["mode"] == "Fixed" and cfg[source]["fixed"]["pulse"]["enabled"]:
+            pulse_cfg = cfg[source]["fixed"]["pulse"]
+            pulse_info.append(
+                {
+                    "enabled": True,
+                    "delta": pulse_cfg["delta"],
+                    "delay": pulse_cfg["delay"],
+                }
+            )
+        else:
+            pulse_info.append({"enabled": False})
+    return pulse_info
+
+
+def measurement_settings(cfg):
+    """
+    Arguments of `AcquisitionEngine.start` for the mode configuration `cfg`
+    """
+    return {
+        "points": build_points(cfg),
+        "delay": cfg["period"],
+        "n_points": cfg["n_points"],
+        "pulse_info": build_pulse_info(cfg),
+        "instrument_sweep": cfg["instrument_sweep"],
+        "profile": SPEED_PROFILES[cfg["profile"]],
+    }
+
+
+def check_settings(
+    points,
+    delay=1,
+    n_points=1,
+    pulse_info=None,
+    instrument_sweep=True,
+    profile=None,
+    **kwargs,
+):
+    """
+    Raise ValueError if the arguments of `AcquisitionEngine.start` cannot be
+    run: the pulses timed by the instrument must fit in the period
+    """
+    if len(points) != 1 or not instrument_sweep or pulse_info is None:
+        return
+    pulses = [pulse for pulse in pulse_info if pulse.get("enabled", False)]
+    if not pulses:
+        return
+    # the Vg pulse sets the timing when both SMUs pulse, as in `acquire`
+    pulse_delay = pulses[0]["delay"]
+    nplc = profile["nplc"] if profile is not None else 1
+    check_pulse_timing(
+        pulse_delay, pulse_delay, delay, integration_time(nplc, n_points)
+    )
+
+
+def saving_columns(cfg):
+    """
+    Columns saved for the mode configuration `cfg`
+    """
+    return [
+        c
+        for c in ["Time", "Vg", "Vd", "Id", "Ig", "Host time"]
+        if cfg["saving"].get(c, False)
+    ]
+
+
+class PeriodicScheduler:
+    """
+    Deadline-based scheduler ticking every `period` seconds on the monotonic
+    clock: the deadlines are absolute, so the time spent between two ticks
+    does not make the period drift
+
+    policy: what to do when whole periods have been missed
+    - "catch_up": run the missed ticks back to back
+    - "skip": drop the missed ticks and wait for the next deadline
+    tolerance: lateness (s) above which a tick is counted as late
+    """
+
+    def __init__(self, period, policy="skip", tolerance=None):
+        self.period = period
+        self.policy = policy
+        self.tolerance = period / 10 if tolerance is None else tolerance
+        self.start()
+
+    def start(self):
+        self.t0 = time.perf_counter()
+        self.ticks = 0
+        self.missed = 0
+        self.late = 0
+        self.max_lateness = 0
+
+    def wait(self, sleep=time.sleep):
+        """
+        Sleep until the next deadline, returns how late (s) the tick is
+
+        sleep: function sleeping for a duration (s), e.g. the wait of an event
+        interrupting the sleep
+        """
+        deadline = self.next_deadline()
+        now = time.perf_counter()
+        if now < deadline:
+            sleep(deadline - now)
+        return self.tick(deadline)
+
+    def next_deadline(self):
+        """
+        Deadline (perf_counter) of the next tick, for the callers sleeping by
+        themselves (e.g. with asyncio) before calling `tick`
+        """
+        self.ticks += 1
+        return self.t0 + self.ticks * self.period
+
+    def tick(self, deadline):
+        """
+        Count the tick of `deadline` happening now, returns how late (s) it is
+        """
+        lateness = time.perf_counter() - deadline
+        if self.period > 0 and lateness >= self.period:
+            missed = int(lateness // self.period)
+            self.missed += missed
+            if self.policy == "skip":
+                self.ticks += missed
+                lateness -= missed * self.period
+        if lateness > self.tolerance:
+            self.late += 1
+        self.max_lateness = max(self.max_lateness, lateness)
+        return lateness
+
+
+class AcquisitionEngine:
+    """
+    Acquisition loop running in a background thread, without Qt
+
+    `on_data` is called at most every PUBLISH_INTERVAL when new samples have
+    been recorded and `on_end` when the measurement ends, both from the
+    acquisition thread. The samples can also be iterated with `iter_samples`.
+    """
+
+    PUBLISH_INTERVAL = 0.05
+
+    # Interval (s) between two readouts of an on-instrument sweep
+    SWEEP_POLL_INTERVAL = 0.25
+    # Number of pulses of each pulse train run by the instrument
+    PULSE_BLOCK = 1000
+    # What to do with the missed periods of the time mode (see PeriodicScheduler)
+    SCHEDULER_POLICY = "skip"
+    COLUMNS = ("Time", "Host time", "Vg", "Vd", "Id", "Ig")
+
+    def __init__(
+        self,
+        keithley_address,
+        dummy=False,
+        reset=True,
+        on_data=None,
+        on_end=None,
+        transcript=None,
+        verify=False,
+        dummy_options=None,
+    ):
+        # dummy_options: arguments of KeithleyDummy (interface, latency, seed)
+        self.keithley = (
+            KeithleyDummy(keithley_address, **(dummy_options or {}))
+            if dummy
+            else Keithley(
+                keithley_address, verify=verify, reset=reset, transcript=transcript
+            )
+        )
+        self.keithley.set_source_function("b", "OUTPUT_DCVOLTS")
+        self.keithley.set_source_function("a", "OUTPUT_DCVOLTS")
+        self.on_data = on_data
+        self.on_end = on_end
+        self.points = []
+        self.data = ColumnStore(self.COLUMNS)
+        self.recording = False
+        # set by stop, interrupts the sleeps of the acquisition thread
+        self.stopping = threading.Event()
+        self.pulse_info = [{"enabled": False}, {"enabled": False}]
+        self.scheduler = None
+        self.metrics = LoopMetrics()
+        self.stream = None
+        self.thread = None
+        # exception that ended the last measurement, raised by `wait`
+        self.error = None
+        # queues of the running `iter_samples`
+        self.queues = []
+
+    def set_points(self, points):
+        self.points = points
+
+    def notify(self, callback):
+        if callback is not None:
+            callback()
+
+    def start(
+        self,
+        points,
+        delay=1,
+        n_points=1,
+        pulse_info=None,
+        instrument_sweep=True,
+        profile=None,
+        max_samples=None,
+        stream=None,
+    ):
+        """
+        Configure the instrument and start recording in the background
+
+        max_samples: keep only the last `max_samples` samples in memory
+        stream: (filename, columns) to append the samples to while
+        recording, in binary format if filename ends with .bin, as TSV
+        otherwise
+
+        Raises ValueError if the settings cannot be run, see `check_settings`.
+        """
+        check_settings(points, delay, n_points, pulse_info, instrument_sweep, profile)
+
+        # command statistics and loop metrics of this measurement only
+        self.keithley.stats.reset()
+        self.metrics.reset(delay)
+
+        # reset the keithley only if the speed profile or the averaging
+        # (done by the instrument) changed since the last run
+        self.keithley.configure({"profile": profile, "n_points": n_points})
+
+        with self.keithley.batch():
+            self.keithley.set_source_function("b", "OUTPUT_DCVOLTS")
+            self.keithley.set_source_function("a", "OUTPUT_DCVOLTS")
+
+            # start from the first point, the instrument is not reset between
+            # runs with the same configuration
+            if len(points):
+                self.keithley.set_voltage_source("b", points[0][0])
+                self.keithley.set_voltage_source("a", points[0][1])
+
+            # start the measurement
+            self.keithley.turn_output_on("b")
+            self.keithley.turn_output_on("a")
+
+        self.points = points
+        self.delay = delay
+        self.n_points = n_points
+        self.instrument_sweep = instrument_sweep
+        self.data = ColumnStore(self.COLUMNS, max_length=max_samples)
+        self.stream = None
+        if stream is not None:
+            filename, columns = stream
+            fmt = "bin" if filename.endswith(".bin") else "tsv"
+            self.stream = StreamWriter(filename, columns, fmt)
+            self.stream.start()
+
+        # Handle pulse information
+        if pulse_info is not None:
+            self.pulse_info = pulse_info
+        else:
+            self.pulse_info = [{"enabled": False}, {"enabled": False}]
+
+        self.recording = True
+        self.error = None
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.record, daemon=True)
+        self.thread.start()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the end of the measurement, returns False on timeout
+
+        Raises the exception that ended the measurement, if any (e.g. a VISA
+        timeout).
+        """
+        if self.thread is not None:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+    def run(self, *args, **kwargs):
+        """
+        Record a whole measurement (arguments of `start`), blocking
+        """
+        self.start(*args, **kwargs)
+        self.wait()
+
+    def iter_samples(self, *args, **kwargs):
+        """
+        Start a measurement (arguments of `start`) and iterate over the new
+        samples, as dicts mapping the column names to arrays. The outputs are
+        turned off at the end, also if the iteration is interrupted (use
+        `wait` to wait for the end of the recording thread). The exception
+        that ended the measurement, if any, is raised after the last samples.
+        """
+        samples = queue.Queue()
+        self.queues.append(samples)
+        try:
+            self.start(*args, **kwargs)
+            while True:
+                values = samples.get()
+                if values is None:
+                    break
+                yield values
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.queues.remove(samples)
+            self.stop()
+
+    def command_stats(self):
+        """
+        Latency, bytes and count of the instrument calls since the start of
+        the measurement, per command type (see `CommandStats.snapshot`)
+        """
+        return self.keithley.stats.snapshot()
+
+    def loop_metrics(self):
+        """
+        Health of the acquisition loop (see `LoopMetrics.snapshot`), with the
+        time spent in instrument calls, the periods missed and the samples
+        taken late by the scheduler of the time mode, the samples waiting in
+        the `iter_samples` queues (backlog) and the memory of the samples
+        """
+        io_time = sum(s["total"] for s in self.command_stats()["commands"].values())
+        metrics = self.metrics.snapshot(io_time)
+        metrics["recording"] = self.recording
+        scheduler = self.scheduler
+        metrics["missed_periods"] = scheduler.missed if scheduler else None
+        metrics["late_samples"] = scheduler.late if scheduler else None
+        metrics["backlog"] = sum(
+            len(values["Time"])
+            for samples in list(self.queues)
+            for values in list(samples.queue)
+            if values is not None
+        )
+        metrics["buffer_bytes"] = self.data.nbytes
+        return metrics
+
+    def get_response_time(self, n_points=1, n=3):
+        # Calculate the response time of the Keithley
+        times = []
+        for _ in range(n):
+            start_time = time.time()
+            for _ in range(n_points):
+                self.keithley.measure_all()
+            end_time = time.time()
+            times.append(end_time - start_time)
+        return sum(times) / len(times)
+
+    def record(self):
+        self.data.clear()
+        self.scheduler = None
+        self.last_publish = 0
+
+        # Time is the instrument clock when available, the host monotonic
+        # clock (perf_counter_ns at each reply) is kept for alignment
+        self.keithley.reset_clock()
+        self.start_ns = time.perf_counter_ns()
+
+        try:
+            self.acquire()
+        except TranscriptMismatch as e:
+            # a replayed measurement ends where the recorded one was stopped
+            print(f"End of the replay: {e}")
+        except Exception as e:
+            # e.g. a VISA timeout or a dropped link, raised by `wait`
+            self.error = e
+            self.outputs_off_after_error()
+        finally:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+
+            self.recording = False
+            for samples in self.queues:
+                samples.put(None)
+            self.notify(self.on_data)
+            self.notify(self.on_end)
+
+    def outputs_off_after_error(self):
+        """
+        Try to turn the outputs off after the measurement failed, the
+        instrument may not answer anymore
+        """
+        try:
+            self.turn_outputs_off()
+        except Exception as e:
+            print(f"Outputs not turned off after {self.error!r}: {e}")
+
+    def acquire(self):
+        """
+        Run the measurement until its end or until the recording is stopped
+        """
+
+        def measure():
+            # both SMUs are triggered together, n_points readings are
+            # averaged by the instrument filter
+            Id, Ig, t = self.keithley.measure_sync()
+            self.add_samples(
+                {
+                    "Time": [t],
+                    "Host time": [self.host_time_now()],
+                    "Vd": [self.keithley.source_v_level("a")],
+                    "Vg": [self.keithley.source_v_level("b")],
+                    "Id": [Id],
+                    "Ig": [Ig],
+                }
+            )
+
+        if len(self.points) == 1:
+            [vg_base, vd_base] = self.points[0]
+
+            # Calculate pulse parameters
+            vg_pulse_enabled = self.pulse_info[0].get("enabled", False)
+            vd_pulse_enabled = self.pulse_info[1].get("enabled", False)
+
+            # Extract pulse parameters for Vd and Vg
+            if vd_pulse_enabled:
+                vd_delta = self.pulse_info[1]["delta"]
+                vd_delay = self.pulse_info[1]["delay"]
+
+            if vg_pulse_enabled:
+                vg_delta = self.pulse_info[0]["delta"]
+                vg_delay = self.pulse_info[0]["delay"]
+
+            if self.instrument_sweep and (vg_pulse_enabled or vd_pulse_enabled):
+                # Pulse trains timed by the instrument
+                pulse_delay = vg_delay if vg_pulse_enabled else vd_delay
+                delta = [
+                    vg_delta if vg_pulse_enabled else 0,
+                    vd_delta if vd_pulse_enabled else 0,
+                ]
+                points = [[vg_base + delta[0], vd_base + delta[1]]] * self.PULSE_BLOCK
+                while self.recording:
+                    block_start = self.host_time_now()
+                    self.keithley.start_pulse_train(
+                        [vg_base, vd_base],
+                        delta,
+                        pulse_delay,
+                        pulse_delay,
+                        self.delay,
+                        self.PULSE_BLOCK,
+                    )
+                    self.read_buffered(points, block_start + 2 * pulse_delay)
+
+            else:
+                self.scheduler = PeriodicScheduler(self.delay, self.SCHEDULER_POLICY)
+                while self.recording:
+                    with self.keithley.batch():
+                        self.keithley.set_voltage_source("a", vd_base)
+                        self.keithley.set_voltage_source("b", vg_base)
+
+                    if vg_pulse_enabled or vd_pulse_enabled:
+                        pulse_delay = vg_delay if vg_pulse_enabled else vd_delay
+
+                        self.sleep(pulse_delay)
+
+                        with self.keithley.batch():
+                            if vd_pulse_enabled:
+                                self.keithley.set_voltage_source(
+                                    "a", vd_base + vd_delta
+                                )
+                            if vg_pulse_enabled:
+                                self.keithley.set_voltage_source(
+                                    "b", vg_base + vg_delta
+                                )
+
+                        self.sleep(pulse_delay)
+
+                    measure()
+                    if vg_pulse_enabled or vd_pulse_enabled:
+                        with self.keithley.batch():
+                            if vd_pulse_enabled:
+                                self.keithley.set_voltage_source("a", vd_base)
+                            if vg_pulse_enabled:
+                                self.keithley.set_voltage_source("b", vg_base)
+
+                    with self.metrics.sleeping():
+                        self.scheduler.wait(self.stopping.wait)
+
+        elif self.instrument_sweep:
+            # Sweep run by the instrument
+            self.keithley.start_sweep(self.points, self.delay)
+            self.read_buffered(self.points, self.delay)
+
+        else:
+            # Standard sweep measurement
+            for [vg, vd] in self.points:
+                if not self.recording:
+                    break
+                with self.keithley.batch():
+                    self.keithley.set_voltage_source("a", vd)
+                    self.keithley.set_voltage_source("b", vg)
+                self.sleep(self.delay)
+                host_time = self.host_time_now()
+                self.add_samples(
+                    {
+                        "Time": [host_time],
+                        "Host time": [host_time],
+                        "Vg": [vg],
+                        "Vd": [vd],
+                        "Id": [self.keithley.measure_i("a")],
+                        "Ig": [self.keithley.measure_i("b")],
+                    }
+                )
+
+    def read_buffered(self, points, first_time):
+        """
+        Read in chunks the results of a sweep (or pulse train) run by the
+        instrument over `points`, until it ends or the recording is stopped
+
+        first_time: time of the first point, the following ones are timed by
+        the instrument
+
+        The Host time of the samples is when their chunk was read, the same
+        for the whole chunk: it is not the time of each sample.
+        """
+        n_read = 0
+        t0 = None
+        while self.recording and n_read < len(points):
+            self.sleep(self.SWEEP_POLL_INTERVAL)
+            n = self.keithley.sweep_count()
+            if n == n_read:
+                continue
+            t, Id, Ig = self.keithley.read_sweep(n_read + 1, n)
+            if t0 is None:
+                t0 = t[0] - first_time
+            self.add_samples(
+                {
+                    "Time": t - t0,
+                    "Host time": np.full(len(t), self.host_time_now()),
+                    "Vg": [p[0] for p in points[n_read:n]],
+                    "Vd": [p[1] for p in points[n_read:n]],
+                    "Id": Id,
+                    "Ig": Ig,
+                }
+            )
+            n_read = n
+        if n_read < len(points):
+            self.keithley.abort_sweep()
+
+    def sleep(self, seconds):
+        """
+        Sleep in the acquisition thread, until `stop` is called at most
+        """
+        with self.metrics.sleeping():
+            self.stopping.wait(seconds)
+
+    def add_samples(self, values):
+        """
+        Store new samples, `values` maps the column names to sequences
+        """
+        self.data.extend(values)
+        self.metrics.add_samples(np.asarray(values["Time"], dtype=float))
+        if self.stream is not None:
+            self.stream.write(values)
+        for samples in self.queues:
+            samples.put({k: np.asarray(v, dtype=float) for k, v in values.items()})
+        now = time.perf_counter()
+        if now - self.last_publish >= self.PUBLISH_INTERVAL:
+            self.last_publish = now
+            self.notify(self.on_data)
+
+    def host_time_now(self):
+        """
+        Host monotonic time (s) since the start of the recording
+        """
+        return (time.perf_counter_ns() - self.start_ns) / 1e9
+
+    @property
+    def time(self):
+        return self.data["Time"]
+
+    @property
+    def host_time(self):
+        return self.data["Host time"]
+
+    @property
+    def vg(self):
+        return self.data["Vg"]
+
+    @property
+    def vd(self):
+        return self.data["Vd"]
+
+    @property
+    def id(self):
+        return self.data["Id"]
+
+    @property
+    def ig(self):
+        return self.data["Ig"]
+
+    def stop(self):
+        """
+        Stop the recording and turn the outputs off, once the acquisition
+        thread has ended (and aborted a sweep run by the instrument)
+        """
+        self.recording = False
+        self.stopping.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        # after an error, the acquisition thread has already tried
+        if self.error is None:
+            self.turn_outputs_off()
+
+    def turn_outputs_off(self):
+        with self.keithley.batch():
+            self.keithley.turn_output_off("b")
+            self.keithley.turn_output_off("a")
+
+    def close(self):
+        self.keithley.close()
+
+    def save(self, filename, columns=None):
+        if columns is None:
+            columns = ["Time", "Vg", "Vd", "Id", "Ig"]
+        df = pandas.DataFrame(dict(zip(columns, self.data.view(*columns))))
+        df.to_csv(filename, index=False, sep="\t")
+        return df
@@ -0,0 +1,190 @@
+import bisect
+import json
+import re
+import threading
+import time
+from functools import lru_cache
+
+# Numbers of a TSP command, not the digits of names such as nvbuffer1
+NUMBER = re.compile(r"(?<![\w.])[-+]?\d+(\.\d*)?([eE][-+]?\d+)?")
+
+
+@lru_cache(maxsize=1024)
+def command_type(command):
+    """
+    Type of a TSP command, grouping the calls in the statistics: the command
+    with its numbers replaced by #, the first line of a script upload, or
+    "batch" for several statements sent together
+    """
+    if command.startswith("loadscript"):
+        return command.split("\n", 1)[0]
+    if "\n" in command:
+        return "batch"
+    return NUMBER.sub("#", command)[:80]
+
+
+# Bin edges (ns) of the latency histograms: 10 bins per decade from 1 µs to
+# 100 s
+BINS_PER_DECADE = 10
+EDGES = [round(10 ** (3 + i / BINS_PER_DECADE)) for i in range(8 * BINS_PER_DECADE)]
+EDGES.append(10**11)
+
+
+class LatencyHistogram:
+    """
+    Histogram of durations (ns) with the log-spaced bins of EDGES
+    """
+
+    def __init__(self):
+        # counts[0] below the first edge, counts[-1] above the last one
+        self.counts = [0] * (len(EDGES) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, duration):
+        self.counts[bisect.bisect_right(EDGES, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+
+    def quantile(self, q):
+        """
+        Upper edge of the bin holding the quantile `q` (ns), bounded by the
+        extreme durations
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            cumulative += n
+            if cumulative >= rank and n:
+                edge = EDGES[i] if i < len(EDGES) else self.max
+                return min(max(edge, self.min), self.max)
+        return self.max
+
+
+class CommandStats:
+    """
+    Latency, bytes and count of the calls to an instrument, per command type
+    (see `command_type`)
+
+    `snapshot` gives the statistics as a dict, durations in seconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.start = time.perf_counter_ns()
+
+    def reset(self):
+        with self.lock:
+            self.commands = {}
+            self.start = time.perf_counter_ns()
+
+    def record(self, op, command, duration, bytes_out, bytes_in=0):
+        """
+        Add a call of `duration` (ns) sending `bytes_out` bytes and receiving
+        `bytes_in` bytes
+        """
+        key = command_type(command)
+        with self.lock:
+            stats = self.commands.get(key)
+            if stats is None:
+                stats = self.commands[key] = {
+                    "op": op,
+                    "histogram": LatencyHistogram(),
+                    "bytes_out": 0,
+                    "bytes_in": 0,
+                }
+            stats["histogram"].add(duration)
+            stats["bytes_out"] += bytes_out
+            stats["bytes_in"] += bytes_in
+
+    def snapshot(self):
+        """
+        Statistics since the last reset: the elapsed time, the histogram bin
+        edges and, for each command type, the call count, the total, mean,
+        min, max, p50 and p99 durations, the bytes sent and received and the
+        histogram counts
+        """
+        with self.lock:
+            commands = {}
+            for key, stats in self.commands.items():
+                h = stats["histogram"]
+                commands[key] = {
+                    "op": stats["op"],
+                    "count": h.count,
+                    "total": h.total / 1e9,
+                    "mean": h.total / h.count / 1e9,
+                    "min": h.min / 1e9,
+                    "max": h.max / 1e9,
+                    "p50": h.quantile(0.5) / 1e9,
+                    "p99": h.quantile(0.99) / 1e9,
+                    "bytes_out": stats["bytes_out"],
+                    "bytes_in": stats["bytes_in"],
+                    "histogram": list(h.counts),
+                }
+            return {
+                "elapsed": (time.perf_counter_ns() - self.start) / 1e9,
+                "edges": [edge / 1e9 for edge in EDGES],
+                "commands": commands,
+            }
+
+    def dump(self, filename):
+        """
+        Write the snapshot to a JSON file
+        """
+        with open(filename, "w") as f:
+            json.dump(self.snapshot(), f, indent=4)
+
+
+class InstrumentedSession:
+    """
+    VISA session wrapper timing the calls (perf_counter_ns) into `stats`
+    """
+
+    def __init__(self, session, stats=None):
+        self.session = session
+        self.stats = stats if stats is not None else CommandStats()
+
+    def write(self, command):
+        start = time.perf_counter_ns()
+        result = self.session.write(command)
+        self.stats.record(
+            "write", command, time.perf_counter_ns() - start, len(command) + 1
+        )
+        return result
+
+    def query(self, command):
+        start = time.perf_counter_ns()
+        reply = self.session.query(command)
+        self.stats.record(
+            "query",
+            command,
+            time.perf_counter_ns() - start,
+            len(command) + 1,
+            len(reply) + 1,
+        )
+        return reply
+
+    def query_binary_values(self, command, **kwargs):
+        start = time.perf_counter_ns()
+        values = self.session.query_binary_values(command, **kwargs)
+        # 8 bytes per REAL64 value, without the block header
+        self.stats.record(
+            "query",
+            command,
+            time.perf_counter_ns() - start,
+            len(command) + 1,
+            8 * len(values),
+        )
+        return values
+
+    def close(self):
+        self.session.close()
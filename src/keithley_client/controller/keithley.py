@@ -1,70 +1,684 @@
+import copy
+import threading
+from contextlib import contextmanager
+
+import numpy as np
 import pyvisa
 
+from .instrumentation import InstrumentedSession
+from .transcript import TranscriptRecorder, TranscriptReplay
+
+# State of each instrument shared by all the Keithley instances of the
+# process (see `InstrumentState`), by address
+resource_manager = None
+instruments = {}
+
+# Power line frequency (Hz) assumed to convert NPLC into seconds: 50 Hz gives
+# the longer integration times
+LINE_FREQUENCY = 50
+
+
+# Significant digits of the numbers printed in ASCII (6 after a reset), enough
+# to keep the instrument timestamps of `measure_sync` at µs resolution over
+# days
+ASCII_PRECISION = 15
+
+# TSP function measuring both SMUs on the same trigger event: smub waits for
+# the event armed by smua, the shared timestamp is the instrument timer when
+# the measurement is triggered
+SYNC_SCRIPT = [
+    "loadscript kc_sync",
+    "function kc_sample()",
+    "  for _, smu in ipairs({smua, smub}) do",
+    "    smu.nvbuffer2.clear()",
+    "    smu.trigger.source.action = smu.DISABLE",
+    "    smu.trigger.source.stimulus = 0",
+    "    smu.trigger.measure.i(smu.nvbuffer2)",
+    "    smu.trigger.measure.action = smu.ENABLE",
+    "    smu.trigger.measure.stimulus = smua.trigger.ARMED_EVENT_ID",
+    "    smu.trigger.endpulse.action = smu.SOURCE_HOLD",
+    "    smu.trigger.endpulse.stimulus = 0",
+    "    smu.trigger.count = 1",
+    "  end",
+    "  smub.trigger.initiate()",
+    "  local t = timer.measure.t()",
+    "  smua.trigger.initiate()",
+    "  waitcomplete()",
+    "  printnumber(smua.nvbuffer2.readings[1], smub.nvbuffer2.readings[1], t)",
+    "end",
+    "endscript",
+    "kc_sync.run()",
+]
+
+
+def open_session(address, transcript=None):
+    """
+    Open a VISA session to `address`
+
+    `REPLAY::FILE` replays the transcript FILE at the original speed,
+    `REPLAY::FILE::FAST` as fast as possible (see `TranscriptReplay`).
+    With `transcript`, the calls are recorded to that file. The calls are
+    timed by an `InstrumentedSession`.
+    """
+    global resource_manager
+    if address.startswith("REPLAY::"):
+        filename = address.removeprefix("REPLAY::")
+        fast = filename.endswith("::FAST")
+        session = TranscriptReplay(filename.removesuffix("::FAST"), realtime=not fast)
+    else:
+        if resource_manager is None:
+            resource_manager = pyvisa.ResourceManager("@py")
+        kwargs = {}
+        if address.endswith("::SOCKET"):
+            # raw sockets have no end of message, TSP lines end with \n
+            kwargs = {"read_termination": "\n", "write_termination": "\n"}
+        session = resource_manager.open_resource(address, **kwargs)
+    if transcript is not None:
+        session = TranscriptRecorder(session, transcript)
+    return InstrumentedSession(session)
+
+
+class InstrumentState:
+    """
+    VISA session of an instrument with the lock serializing the calls, the
+    number of Keithley instances using it and what is known of the
+    instrument: the configuration applied (None since the last reset or
+    attach, see `Keithley.configure`), the source settings, the data format
+    and whether the sync script is loaded
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.lock = threading.RLock()
+        self.users = 0
+        self.configuration = None
+        self.source_state = {"a": {}, "b": {}}
+        self.data_format = None
+        self.sync_loaded = False
+        self.nplc = 1
+        self.filter_count = {"a": 1, "b": 1}
+
+
+def open_instrument(address, transcript=None):
+    """
+    Shared state of the instrument at `address`, its session is opened by
+    the first user
+    """
+    if address not in instruments:
+        instruments[address] = InstrumentState(open_session(address, transcript))
+    state = instruments[address]
+    state.users += 1
+    return state
+
+
+def close_instrument(address):
+    """
+    Release the instrument at `address`, its session is closed with the
+    last user
+    """
+    state = instruments.get(address)
+    if state is None:
+        return
+    state.users -= 1
+    if state.users == 0:
+        del instruments[address]
+        state.session.close()
+
+
+def integration_time(nplc, filter_count=1):
+    """
+    Duration (s) of a measurement integrating over `nplc` power line cycles
+    and averaging `filter_count` readings, at LINE_FREQUENCY
+    """
+    return nplc / LINE_FREQUENCY * filter_count
+
+
+def check_pulse_timing(delay, width, period, integration):
+    """
+    Raise ValueError if a pulse (`delay` at the base levels, `width` to the
+    measurement and the `integration` time of the measurement, in s) does
+    not fit in the pulse `period`
+    """
+    needed = delay + width + integration
+    if period < needed:
+        raise ValueError(
+            f"The pulse period ({period:g} s) is shorter than the pulse delay, "
+            f"width and measurement ({needed:g} s)"
+        )
+
+
+def _tsp_number(value):
+    """
+    TSP literal of a number, the shortest repr giving back the same float64
+    """
+    return repr(float(value))
+
+
+def _tsp_table(name, values, chunk=100):
+    """
+    TSP lines building the Lua table `name` from a list of numbers, split in
+    chunks to keep each line short
+    """
+    lines = [f"local {name} = {{}}"]
+    for i in range(0, len(values), chunk):
+        items = ", ".join(_tsp_number(v) for v in values[i : i + chunk])
+        lines.append(f"for _, v in ipairs({{{items}}}) do {name}[#{name} + 1] = v end")
+    return lines
+
 
 class Keithley:
     """
     Keithley class to control the Keithley SMU
     """
 
-    def __init__(self, address):
-        self.instrument = pyvisa.ResourceManager("@py").open_resource(address)
-        self.reset()
+    # Maximum length of a single write when sending batched statements
+    MAX_BATCH_LENGTH = 2048
+
+    def __init__(self, address, verify=False, reset=True, transcript=None):
+        """
+        verify: read the source levels back from the instrument instead of
+        using the cached values
+        reset: reset the instrument, otherwise attach to it as it is
+        transcript: file recording the VISA calls (see `TranscriptRecorder`)
+        """
+        self.address = address
+        self.state = open_instrument(address, transcript)
+        self.instrument = self.state.session
+        # held by the thread writing to the instrument or collecting a batch
+        self.lock = self.state.lock
+        # latency, bytes and count of the calls, per command type
+        self.stats = self.instrument.stats
+        self.verify = verify
+        self.batched = None
+        if reset:
+            self.reset()
+        else:
+            self.set_number_format()
+
+    # the cached instrument state is shared by the instances on the address
+    @property
+    def source_state(self):
+        return self.state.source_state
+
+    @property
+    def data_format(self):
+        return self.state.data_format
+
+    @data_format.setter
+    def data_format(self, data_format):
+        self.state.data_format = data_format
+
+    @property
+    def sync_loaded(self):
+        return self.state.sync_loaded
+
+    @sync_loaded.setter
+    def sync_loaded(self, loaded):
+        self.state.sync_loaded = loaded
+
+    def close(self):
+        if self.state is not None:
+            close_instrument(self.address)
+            self.state = None
+
+    def write(self, command):
+        with self.lock:
+            if self.batched is not None:
+                self.batched.append(command)
+            else:
+                self.instrument.write(command)
+
+    def query(self, command):
+        with self.lock:
+            self.flush()
+            return self.instrument.query(command)
 
-    def __del__(self):
-        self.instrument.close()
+    def query_binary_values(self, command, **kwargs):
+        with self.lock:
+            self.flush()
+            return self.instrument.query_binary_values(command, **kwargs)
+
+    @contextmanager
+    def batch(self):
+        """
+        Collect the TSP statements written inside the block and send them
+        joined by newlines in as few writes as possible on exit
+
+        Queries inside the block send the statements collected so far first.
+        Nested blocks are merged into the outermost one. The instrument lock
+        is held for the whole block: the calls of other threads wait for the
+        batch to be sent.
+        """
+        with self.lock:
+            if self.batched is not None:
+                yield
+                return
+            self.batched = []
+            try:
+                yield
+            finally:
+                try:
+                    self.flush()
+                finally:
+                    self.batched = None
+
+    def flush(self):
+        """
+        Send the batched statements
+        """
+        if not self.batched:
+            return
+        commands, self.batched = self.batched, []
+        message = commands[0]
+        for command in commands[1:]:
+            if len(message) + len(command) + 1 > self.MAX_BATCH_LENGTH:
+                self.instrument.write(message)
+                message = command
+            else:
+                message += "\n" + command
+        self.instrument.write(message)
 
     def reset(self):
-        self.instrument.write("*RST")
-        self.instrument.write("smua.measure.autorangei = smua.AUTORANGE_ON")
-        self.instrument.write("smub.measure.autorangei = smua.AUTORANGE_ON")
-        self.instrument.write("smua.measure.lowrangei = 1e-6")
-        self.instrument.write("smub.measure.lowrangei = 1e-6")
+        self.write("*RST")
+        with self.batch():
+            self.write("smua.measure.autorangei = smua.AUTORANGE_ON")
+            self.write("smub.measure.autorangei = smua.AUTORANGE_ON")
+            self.write("smua.measure.lowrangei = 1e-6")
+            self.write("smub.measure.lowrangei = 1e-6")
+            self.set_number_format()
+        self.data_format = "ASCII"
+        for settings in self.source_state.values():
+            settings.clear()
+        self.sync_loaded = False
+        self.state.configuration = None
+        self.state.nplc = 1
+        self.state.filter_count = {"a": 1, "b": 1}
+
+    def configure(self, config):
+        """
+        Apply the measurement `config`, a dict with the speed `profile` and
+        the `n_points` averaged by the instrument
+
+        Nothing is sent if `config` is the configuration already applied to
+        the instrument. The instrument is reset first if another
+        configuration has been applied since the last reset (or attach).
+        Returns True if the configuration has been applied.
+        """
+        with self.lock:
+            if self.state.configuration == config:
+                return False
+            if self.state.configuration is not None:
+                self.reset()
+            with self.batch():
+                if config.get("profile") is not None:
+                    self.set_speed_profile(config["profile"])
+                self.set_averaging("a", config.get("n_points", 1))
+                self.set_averaging("b", config.get("n_points", 1))
+            self.state.configuration = copy.deepcopy(config)
+            return True
+
+    def set_source(self, smu, key, value, command):
+        """
+        Write `command`, setting the source `key` of `smu` to `value`, unless
+        the cached state already holds that value
+        """
+        with self.lock:
+            if self.source_state[smu].get(key) == value:
+                return
+            self.write(command)
+            self.source_state[smu][key] = value
+
+    def set_number_format(self):
+        """
+        Byte order of REAL64 data and precision of ASCII numbers, both reset
+        with the instrument
+        """
+        with self.batch():
+            self.write("format.byteorder = format.LITTLEENDIAN")
+            self.write(f"format.asciiprecision = {ASCII_PRECISION}")
+
+    def set_data_format(self, data_format):
+        """
+        Set the format used by printnumber and printbuffer ("ASCII" or "REAL64")
+        """
+        with self.lock:
+            if data_format != self.data_format:
+                self.write(f"format.data = format.{data_format}")
+                self.data_format = data_format
 
     def set_source_function(self, smu, function):
-        self.instrument.write(f"smu{smu}.source.func = smu{smu}.{function}")
+        self.set_source(
+            smu, "func", function, f"smu{smu}.source.func = smu{smu}.{function}"
+        )
 
     def set_voltage_source(self, smu, voltage):
-        self.instrument.write(f"smu{smu}.source.levelv = {voltage}")
+        self.set_source(smu, "levelv", voltage, f"smu{smu}.source.levelv = {voltage}")
 
     def set_current_source(self, smu, current):
-        self.instrument.write(f"smu{smu}.source.leveli = {current}")
+        self.set_source(smu, "leveli", current, f"smu{smu}.source.leveli = {current}")
 
     def set_voltage_limit(self, smu, voltage):
-        self.instrument.write(f"smu{smu}.source.limitv = {voltage}")
+        self.set_source(smu, "limitv", voltage, f"smu{smu}.source.limitv = {voltage}")
 
     def set_current_limit(self, smu, current):
-        self.instrument.write(f"smu{smu}.source.limiti = {current}")
+        self.set_source(smu, "limiti", current, f"smu{smu}.source.limiti = {current}")
 
     def turn_output_on(self, smu):
-        self.instrument.write(f"smu{smu}.source.output = smu{smu}.OUTPUT_ON")
+        self.set_source(
+            smu, "output", True, f"smu{smu}.source.output = smu{smu}.OUTPUT_ON"
+        )
 
     def turn_output_off(self, smu):
-        self.instrument.write(f"smu{smu}.source.output = smu{smu}.OUTPUT_OFF")
+        self.set_source(
+            smu, "output", False, f"smu{smu}.source.output = smu{smu}.OUTPUT_OFF"
+        )
+
+    def set_averaging(self, smu, n, filter_type="REPEAT_AVG"):
+        """
+        Average `n` readings on the instrument for each measurement
+
+        filter_type: "REPEAT_AVG", "MOVING_AVG" or "MEDIAN"
+        """
+        with self.batch():
+            self.write(f"smu{smu}.measure.count = 1")
+            self.write(f"smu{smu}.measure.filter.count = {n}")
+            self.write(f"smu{smu}.measure.filter.type = smu{smu}.FILTER_{filter_type}")
+            state = "FILTER_ON" if n > 1 else "FILTER_OFF"
+            self.write(f"smu{smu}.measure.filter.enable = smu{smu}.{state}")
+        self.state.filter_count[smu] = n
+
+    def set_speed_profile(self, profile):
+        """
+        Apply a speed/accuracy profile (see `config.SPEED_PROFILES`) to both SMUs
+        """
+        with self.batch():
+            for smu in ["a", "b"]:
+                self.write(f"smu{smu}.measure.nplc = {profile['nplc']}")
+                self.write(
+                    f"smu{smu}.measure.autozero = smu{smu}.AUTOZERO_{profile['autozero']}"
+                )
+                if profile["autorange"]:
+                    self.write(f"smu{smu}.measure.autorangei = smu{smu}.AUTORANGE_ON")
+                    self.write(f"smu{smu}.measure.lowrangei = {profile['lowrangei']}")
+                else:
+                    self.write(f"smu{smu}.measure.autorangei = smu{smu}.AUTORANGE_OFF")
+                    self.write(f"smu{smu}.measure.rangei = {profile['rangei']}")
+                self.write(f"smu{smu}.measure.delay = {profile['delay']}")
+        self.state.nplc = profile["nplc"]
+
+    def integration_time(self, smu):
+        """
+        Duration (s) of a measurement of `smu`, see `integration_time`
+        """
+        return integration_time(self.state.nplc, self.state.filter_count[smu])
 
     def beep(self):
-        self.instrument.write("beeper.enable = beeper.ON")
-        self.instrument.write("beeper.beep(1, 1200)")
-        self.instrument.write("beeper.enable = beeper.OFF")
+        with self.batch():
+            self.write("beeper.enable = beeper.ON")
+            self.write("beeper.beep(1, 1200)")
+            self.write("beeper.enable = beeper.OFF")
 
     def source_i_level(self, smu):
-        return self.instrument.query(f"print(smu{smu}.source.leveli)")
+        if not self.verify and "leveli" in self.source_state[smu]:
+            return self.source_state[smu]["leveli"]
+        return float(self.query(f"print(smu{smu}.source.leveli)"))
 
     def source_v_level(self, smu):
-        return self.instrument.query(f"print(smu{smu}.source.levelv)")
+        if not self.verify and "levelv" in self.source_state[smu]:
+            return self.source_state[smu]["levelv"]
+        return float(self.query(f"print(smu{smu}.source.levelv)"))
 
     def measure_i(self, smu):
-        res = self.instrument.query(f"print(smu{smu}.measure.i())")
+        res = self.query(f"print(smu{smu}.measure.i())")
         return float(res)
 
     def measure_v(self, smu):
-        res = self.instrument.query(f"print(smu{smu}.measure.v())")
+        res = self.query(f"print(smu{smu}.measure.v())")
         return float(res)
 
+    def measure_all(self):
+        """
+        Measure Id (smua), Ig (smub) and read back Vd and Vg in a single query
+
+        The source levels come from the cache unless `verify` is set.
+        """
+        with self.lock:
+            self.set_data_format("ASCII")
+            if not self.verify and all(
+                "levelv" in s for s in self.source_state.values()
+            ):
+                res = self.query("printnumber(smua.measure.i(), smub.measure.i())")
+                return [float(v) for v in res.split(",")] + [
+                    self.source_state["a"]["levelv"],
+                    self.source_state["b"]["levelv"],
+                ]
+            res = self.query(
+                "printnumber(smua.measure.i(), smub.measure.i(), "
+                "smua.source.levelv, smub.source.levelv)"
+            )
+            return [float(v) for v in res.split(",")]
+
+    def reset_clock(self):
+        """
+        Reset the instrument timer used by `measure_sync`
+        """
+        self.write("timer.reset()")
+
+    def measure_sync(self):
+        """
+        Measure Id (smua) and Ig (smub) triggered together in a single
+        trigger-model step
+
+        Returns Id, Ig and the instrument time (s since `reset_clock`) of the
+        trigger
+        """
+        with self.lock:
+            if not self.sync_loaded:
+                with self.batch():
+                    for line in SYNC_SCRIPT:
+                        self.write(line)
+                self.sync_loaded = True
+            self.set_data_format("ASCII")
+            res = self.query("kc_sample()")
+            return [float(v) for v in res.split(",")]
+
     def reset_smu(self, smu):
-        self.instrument.write(f"smu{smu}.reset()")
+        self.write(f"smu{smu}.reset()")
+        self.source_state[smu].clear()
 
     def set_source_v_level(self, smu, level):
-        self.instrument.write(f"smu{smu}.source.levelv = {level}")
+        self.set_voltage_source(smu, level)
 
     def set_source_i_level(self, smu, level):
-        self.instrument.write(f"smu{smu}.source.leveli = {level}")
+        self.set_current_source(smu, level)
+
+    def start_sweep(self, points, delay):
+        """
+        Upload the sweep as a TSP script and run it on the instrument
+
+        The drain (smua) and gate (smub) voltages are loaded in the source
+        lists of the trigger model, both currents are stored in the
+        nvbuffer1 of each SMU. The sweep runs in the background: use
+        `sweep_count` and `read_sweep` to fetch the results.
+
+        points: list of [vg, vd] pairs
+        delay: time (s) between sourcing and measuring each point
+        """
+        vg = [p[0] for p in points]
+        vd = [p[1] for p in points]
+        # the trigger model changes the source levels
+        self.source_state["a"].pop("levelv", None)
+        self.source_state["b"].pop("levelv", None)
+        script = [
+            "loadscript kc_sweep",
+            *_tsp_table("vd", vd),
+            *_tsp_table("vg", vg),
+            "smua.nvbuffer1.clear()",
+            "smub.nvbuffer1.clear()",
+            "smua.nvbuffer1.collecttimestamps = 1",
+            "smub.nvbuffer1.collecttimestamps = 1",
+            "smua.trigger.source.listv(vd)",
+            "smub.trigger.source.listv(vg)",
+            "smua.trigger.source.action = smua.ENABLE",
+            "smub.trigger.source.action = smub.ENABLE",
+            "smua.trigger.measure.i(smua.nvbuffer1)",
+            "smub.trigger.measure.i(smub.nvbuffer1)",
+            "smua.trigger.measure.action = smua.ENABLE",
+            "smub.trigger.measure.action = smub.ENABLE",
+            "smua.trigger.endpulse.action = smua.SOURCE_HOLD",
+            "smub.trigger.endpulse.action = smub.SOURCE_HOLD",
+            "trigger.timer[1].reset()",
+            f"trigger.timer[1].delay = {_tsp_number(delay)}",
+            "trigger.timer[1].count = 1",
+            "trigger.timer[1].passthrough = false",
+            "trigger.timer[1].stimulus = smub.trigger.SOURCE_COMPLETE_EVENT_ID",
+            "smua.trigger.source.stimulus = 0",
+            "smub.trigger.source.stimulus = smua.trigger.SOURCE_COMPLETE_EVENT_ID",
+            "smua.trigger.measure.stimulus = trigger.timer[1].EVENT_ID",
+            "smub.trigger.measure.stimulus = trigger.timer[1].EVENT_ID",
+            "smua.trigger.endpulse.stimulus = 0",
+            "smub.trigger.endpulse.stimulus = 0",
+            f"smua.trigger.count = {len(points)}",
+            f"smub.trigger.count = {len(points)}",
+            "smub.trigger.initiate()",
+            "smua.trigger.initiate()",
+            "endscript",
+        ]
+        with self.batch():
+            for line in script:
+                self.write(line)
+            self.write("kc_sweep.run()")
+
+    def start_pulse_train(self, base, delta, delay, width, period, count):
+        """
+        Run a train of voltage pulses timed by the trigger model of the
+        instrument
+
+        Each period starts at the base levels, after `delay` the pulsing SMUs
+        step to base + delta, both currents are measured `width` after the
+        step, then the pulsing SMUs return to the base levels. The results
+        are stored like a sweep: use `sweep_count` and `read_sweep`.
+
+        base: [vg, vd] levels between the pulses
+        delta: [vg, vd] pulse amplitudes, 0 for an SMU that does not pulse
+        delay: time (s) at the base levels before each pulse
+        width: time (s) from the start of the pulse to the measurement
+        period: time (s) between the start of two pulses
+        count: number of pulses
+
+        Raises ValueError if the delay, width and measurement do not fit in
+        the period.
+        """
+        check_pulse_timing(
+            delay,
+            width,
+            period,
+            max(self.integration_time("a"), self.integration_time("b")),
+        )
+        vg, vd = base
+        dvg, dvd = delta
+        # the pulse width is timed from the step of the (gate) pulse
+        pulsing = "b" if dvg else "a"
+        self.source_state["a"].pop("levelv", None)
+        self.source_state["b"].pop("levelv", None)
+        script = [
+            "loadscript kc_pulse",
+            f"smua.source.levelv = {_tsp_number(vd)}",
+            f"smub.source.levelv = {_tsp_number(vg)}",
+            "smua.nvbuffer1.clear()",
+            "smub.nvbuffer1.clear()",
+            "smua.nvbuffer1.collecttimestamps = 1",
+            "smub.nvbuffer1.collecttimestamps = 1",
+            f"smua.trigger.source.listv({{{_tsp_number(vd + dvd)}}})",
+            f"smub.trigger.source.listv({{{_tsp_number(vg + dvg)}}})",
+            f"smua.trigger.source.action = smua.{'ENABLE' if dvd else 'DISABLE'}",
+            f"smub.trigger.source.action = smub.{'ENABLE' if dvg else 'DISABLE'}",
+            "smua.trigger.measure.i(smua.nvbuffer1)",
+            "smub.trigger.measure.i(smub.nvbuffer1)",
+            "smua.trigger.measure.action = smua.ENABLE",
+            "smub.trigger.measure.action = smub.ENABLE",
+            "smua.trigger.endpulse.action = smua.SOURCE_IDLE",
+            "smub.trigger.endpulse.action = smub.SOURCE_IDLE",
+            # period
+            "trigger.timer[1].reset()",
+            f"trigger.timer[1].delay = {_tsp_number(period)}",
+            f"trigger.timer[1].count = {max(count - 1, 1)}",
+            "trigger.timer[1].passthrough = true",
+            "trigger.timer[1].stimulus = smua.trigger.ARMED_EVENT_ID",
+            # base levels before the pulse
+            "trigger.timer[2].reset()",
+            f"trigger.timer[2].delay = {_tsp_number(delay)}",
+            "trigger.timer[2].count = 1",
+            "trigger.timer[2].passthrough = false",
+            "trigger.timer[2].stimulus = trigger.timer[1].EVENT_ID",
+            # pulse width
+            "trigger.timer[3].reset()",
+            f"trigger.timer[3].delay = {_tsp_number(width)}",
+            "trigger.timer[3].count = 1",
+            "trigger.timer[3].passthrough = false",
+            f"trigger.timer[3].stimulus = smu{pulsing}.trigger.SOURCE_COMPLETE_EVENT_ID",
+            "smua.trigger.source.stimulus = trigger.timer[2].EVENT_ID",
+            "smub.trigger.source.stimulus = trigger.timer[2].EVENT_ID",
+            "smua.trigger.measure.stimulus = trigger.timer[3].EVENT_ID",
+            "smub.trigger.measure.stimulus = trigger.timer[3].EVENT_ID",
+            "smua.trigger.endpulse.stimulus = smua.trigger.MEASURE_COMPLETE_EVENT_ID",
+            "smub.trigger.endpulse.stimulus = smub.trigger.MEASURE_COMPLETE_EVENT_ID",
+            f"smua.trigger.count = {count}",
+            f"smub.trigger.count = {count}",
+            "smub.trigger.initiate()",
+            "smua.trigger.initiate()",
+            "endscript",
+        ]
+        with self.batch():
+            for line in script:
+                self.write(line)
+            self.write("kc_pulse.run()")
+
+    def sweep_count(self):
+        """
+        Number of sweep points (or pulses) measured by both SMUs so far
+        """
+        res = self.query("print(math.min(smua.nvbuffer1.n, smub.nvbuffer1.n))")
+        return int(float(res))
+
+    def read_sweep(self, start, end):
+        """
+        Read the sweep points (or pulses) from `start` to `end` (1-based,
+        inclusive)
+
+        Returns the timestamps, the drain currents and the gate currents
+        """
+        data = self.read_buffers(
+            start,
+            end,
+            [
+                "smua.nvbuffer1.timestamps",
+                "smua.nvbuffer1.readings",
+                "smub.nvbuffer1.readings",
+            ],
+        )
+        return data[:, 0], data[:, 1], data[:, 2]
+
+    def read_buffers(self, start, end, buffers):
+        """
+        Read the `buffers` (e.g. "smua.nvbuffer1.readings") from `start` to
+        `end` (1-based, inclusive) as a single REAL64 binary block
+
+        Returns an array with one column per buffer
+        """
+        with self.lock:
+            self.set_data_format("REAL64")
+            data = self.query_binary_values(
+                f"printbuffer({start}, {end}, {', '.join(buffers)})",
+                datatype="d",
+                is_big_endian=False,
+                container=np.array,
+                # the #0 block header does not give the length of the data
+                data_points=(end - start + 1) * len(buffers),
+            )
+            return data.reshape(-1, len(buffers))
+
+    def abort_sweep(self):
+        with self.batch():
+            self.write("smua.abort()")
+            self.write("smub.abort()")
@@ -1,46 +1,243 @@
-import random
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from .instrumentation import CommandStats
+from .keithley import check_pulse_timing
+
+# Emulated bus latency (s) of each interface:
+# - write/query: (mean, jitter) of a write and of a query round trip
+# - byte: transfer time of each byte of a command or a reply
+INTERFACES = {
+    "none": {"write": (0, 0), "query": (0, 0), "byte": 0},
+    "gpib": {"write": (0.3e-3, 0.05e-3), "query": (1.5e-3, 0.2e-3), "byte": 2e-6},
+    "usb": {"write": (0.2e-3, 0.1e-3), "query": (1.0e-3, 0.4e-3), "byte": 1e-7},
+    "lan": {"write": (0.1e-3, 0.3e-3), "query": (0.8e-3, 1.0e-3), "byte": 1e-7},
+}
+
+
+def interface_of(address):
+    """
+    Interface emulated for a VISA `address`
+    """
+    if address.startswith("GPIB"):
+        return "gpib"
+    if address.startswith("USB"):
+        return "usb"
+    if address.startswith("TCPIP"):
+        return "lan"
+    return "none"
+
+
+class DeviceModel:
+    """
+    Vectorized model of a p-type MOSFET: drain current on smua, gate leakage
+    on smub
+    """
+
+    def __init__(self, vth=0, w_l=635, cox=15e-9, mobility=0.01, seed=None):
+        self.vth = vth  # Threshold voltage for p-type
+        self.kp = w_l * cox * mobility
+        self.rng = np.random.default_rng(seed)
+
+    def drain_current(self, vg, vd):
+        vg = np.asarray(vg, dtype=float)
+        vd = np.asarray(vd, dtype=float)
+        vov = vg - self.vth
+        linear = -self.kp * (vov * vd - 0.5 * vd**2)
+        saturation = -0.5 * self.kp * vov**2
+        Id = np.where(vd > vov, linear, saturation)
+        return np.where(vg > self.vth, 0.0, Id)
+
+    def currents(self, vg, vd):
+        """
+        Noisy Id and Ig for arrays of gate and drain voltages
+        """
+        Id = self.drain_current(vg, vd)
+        Id = Id + self.rng.uniform(-1e-12, 1e-12, Id.shape)
+        Ig = self.rng.uniform(-1e-9, 1e-9, Id.shape)
+        return Id, Ig
 
 
 class KeithleyDummy:
     """
     Dummy Keithley class to simulate the Keithley SMU for testing purposes.
+
+    The transfers take the time of the `interface` ("gpib", "usb", "lan" or
+    "none", from the address by default) and the measurements the
+    integration time of the speed profile, so that the acquisition can be
+    benchmarked without the instrument. `latency` replaces the (mean, jitter)
+    (s) of the writes and queries of the interface. `seed` makes the noise
+    and the jitter reproducible.
     """
 
-    def __init__(self, address, verbose=False):
+    def __init__(
+        self,
+        address,
+        verbose=False,
+        reset=True,
+        interface=None,
+        latency=None,
+        seed=None,
+        line_frequency=50,
+    ):
         self.address = address
+        self.verbose = verbose
+        self.latency = dict(INTERFACES[interface or interface_of(address)])
+        if latency is not None:
+            mean, jitter = latency
+            if mean < 0 or jitter < 0:
+                raise ValueError(f"Invalid latency: {latency}")
+            self.latency["write"] = self.latency["query"] = (mean, jitter)
+        seeds = np.random.SeedSequence(seed).spawn(2)
+        self.model = DeviceModel(seed=seeds[0])
+        self.rng = np.random.default_rng(seeds[1])
+        self.line_frequency = line_frequency
+        self.batched = None
+        self.lock = threading.RLock()
+        self.stats = CommandStats()
+        self.config = None
+        self.nplc = 1
+        self.filter_count = {"a": 1, "b": 1}
         self.output_state = {"a": False, "b": False}
         self.voltage = {"a": 0, "b": 0}
         self.current = {"a": 0, "b": 0}
-        self.verbose = verbose
+        self.source_state = {"a": {}, "b": {}}
+        self.sweep_t = np.zeros(0)
+        self.clock_start = time.perf_counter()
+        if reset:
+            self.reset()
+
+    def transfer(self, kind, nbytes):
+        """
+        Wait for the duration of a `kind` ("write" or "query") transaction of
+        `nbytes`
+        """
+        mean, jitter = self.latency[kind]
+        duration = mean + nbytes * self.latency["byte"]
+        if jitter:
+            duration += self.rng.normal(0, jitter)
+        if duration > 0:
+            time.sleep(duration)
+
+    def write(self, command):
+        if self.verbose:
+            print(command)
+        with self.lock:
+            if self.batched is not None:
+                self.batched.append(command)
+                return
+            start = time.perf_counter_ns()
+            self.transfer("write", len(command) + 1)
+            self.stats.record(
+                "write", command, time.perf_counter_ns() - start, len(command) + 1
+            )
+
+    def query(self, command, reply_bytes=16):
+        start = time.perf_counter_ns()
+        self.transfer("query", len(command) + 1 + reply_bytes)
+        self.stats.record(
+            "query",
+            command,
+            time.perf_counter_ns() - start,
+            len(command) + 1,
+            reply_bytes,
+        )
+
+    @contextmanager
+    def batch(self):
+        with self.lock:
+            if self.batched is not None:
+                yield
+                return
+            self.batched = []
+            try:
+                yield
+            finally:
+                batched, self.batched = self.batched, None
+                if batched:
+                    self.write("\n".join(batched))
+
+    def integration_time(self, smu):
+        return self.nplc / self.line_frequency * self.filter_count[smu]
 
     def reset(self):
+        self.write("*RST")
         self.output_state = {"a": False, "b": False}
         self.voltage = {"a": 0, "b": 0}
         self.current = {"a": 0, "b": 0}
+        self.source_state = {"a": {}, "b": {}}
+        self.nplc = 1
+        self.filter_count = {"a": 1, "b": 1}
+        self.config = None
 
-    def set_source_function(self, smu, function):
+    def configure(self, config):
+        if config == self.config:
+            return False
+        if self.config is not None:
+            self.reset()
+        with self.batch():
+            if config.get("profile") is not None:
+                self.set_speed_profile(config["profile"])
+            self.set_averaging("a", config.get("n_points", 1))
+            self.set_averaging("b", config.get("n_points", 1))
+        self.config = config
+        return True
+
+    def close(self):
+        pass
+
+    def set_source(self, smu, key, value, command):
+        if self.source_state[smu].get(key) == value:
+            return
+        self.write(command)
+        self.source_state[smu][key] = value
+
+    def set_data_format(self, data_format):
         pass
 
+    def set_source_function(self, smu, function):
+        self.set_source(
+            smu, "func", function, f"smu{smu}.source.func = smu{smu}.{function}"
+        )
+
     def set_voltage_source(self, smu, voltage):
+        self.set_source(smu, "levelv", voltage, f"smu{smu}.source.levelv = {voltage:g}")
         self.voltage[smu] = voltage
-        if self.verbose:
-            print(f"Set voltage for {smu} to {voltage} V")
 
     def set_current_source(self, smu, current):
+        self.set_source(smu, "leveli", current, f"smu{smu}.source.leveli = {current:g}")
         self.current[smu] = current
 
     def set_voltage_limit(self, smu, voltage):
-        pass
+        self.set_source(smu, "limitv", voltage, f"smu{smu}.source.limitv = {voltage}")
 
     def set_current_limit(self, smu, current):
-        pass
+        self.set_source(smu, "limiti", current, f"smu{smu}.source.limiti = {current}")
 
     def turn_output_on(self, smu):
+        self.set_source(
+            smu, "output", True, f"smu{smu}.source.output = smu{smu}.OUTPUT_ON"
+        )
         self.output_state[smu] = True
 
     def turn_output_off(self, smu):
+        self.set_source(
+            smu, "output", False, f"smu{smu}.source.output = smu{smu}.OUTPUT_OFF"
+        )
         self.output_state[smu] = False
 
+    def set_averaging(self, smu, n, filter_type="REPEAT_AVG"):
+        self.write(f"smu{smu}.measure.filter.count = {n}")
+        self.filter_count[smu] = n
+
+    def set_speed_profile(self, profile):
+        self.write(f"smua.measure.nplc = {profile['nplc']}")
+        self.write(f"smub.measure.nplc = {profile['nplc']}")
+        self.nplc = profile["nplc"]
+
     def beep(self):
         print("Beep!")
 
@@ -50,41 +247,128 @@ class KeithleyDummy:
     def source_v_level(self, smu):
         return self.voltage[smu]
 
+    def currents(self):
+        """
+        Id and Ig at the current source levels
+        """
+        Id, Ig = self.model.currents(self.voltage["b"], self.voltage["a"])
+        Id = float(Id) if self.output_state["a"] else 0.0
+        Ig = float(Ig) if self.output_state["b"] else 0.0
+        return Id, Ig
+
     def measure_i(self, smu):
-        if self.output_state[smu]:
-            if smu == "a":  # Simulate n-type MOSFET current readings
-                # Simulate p-type MOSFET current readings
-                Vgs = self.voltage["b"]
-                Vds = self.voltage["a"]
-                Vth = 0  # Threshold voltage for p-type
-                W_L = 635  # Width-to-length ratio
-                Cox = 15e-9  # Oxide capacitance per unit area (F/cm^2)
-                mobility = 0.01  # Mobility in cm/Vs
-                Kp = W_L * Cox * mobility
-
-                if Vgs > Vth:
-                    Id = 0
-                else:
-                    if Vds > (Vgs - Vth):
-                        Id = -Kp * ((Vgs - Vth) * Vds - 0.5 * Vds**2)  # Linear region
-                    else:
-                        Id = -0.5 * Kp * (Vgs - Vth) ** 2  # Saturation region
-                return Id + random.uniform(-1e-12, 1e-12)
-            else:
-                return random.uniform(-1e-9, 1e-9)
-        return 0
+        self.query(f"print(smu{smu}.measure.i())")
+        time.sleep(self.integration_time(smu))
+        Id, Ig = self.currents()
+        return Id if smu == "a" else Ig
 
     def measure_v(self, smu):
+        self.query(f"print(smu{smu}.measure.v())")
+        time.sleep(self.integration_time(smu))
         if self.output_state[smu]:
             return self.voltage[smu]  # Return the set voltage
         return 0
 
+    def measure_all(self):
+        # both SMUs are measured one after the other
+        self.query("printnumber(smua.measure.i(), smub.measure.i())", 32)
+        time.sleep(self.integration_time("a") + self.integration_time("b"))
+        Id, Ig = self.currents()
+        return [Id, Ig, self.voltage["a"], self.voltage["b"]]
+
+    def reset_clock(self):
+        self.write("timer.reset()")
+        self.clock_start = time.perf_counter()
+
+    def measure_sync(self):
+        # both SMUs are triggered together
+        t = time.perf_counter() - self.clock_start
+        self.query("kc_sample()", 48)
+        time.sleep(max(self.integration_time("a"), self.integration_time("b")))
+        Id, Ig = self.currents()
+        return [Id, Ig, t]
+
     def reset_smu(self, smu):
+        self.write(f"smu{smu}.reset()")
         self.voltage[smu] = 0
         self.current[smu] = 0
+        self.source_state[smu] = {}
 
     def set_source_v_level(self, smu, level):
-        self.voltage[smu] = level
+        self.set_voltage_source(smu, level)
 
     def set_source_i_level(self, smu, level):
-        self.current[smu] = level
+        self.set_current_source(smu, level)
+
+    def run_buffered(self, points, t):
+        """
+        Emulate a sweep run by the instrument: the points are evaluated at
+        once and become readable at the times `t` (s from now)
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        self.sweep_start = time.perf_counter()
+        self.sweep_t = np.asarray(t, dtype=float)
+        Id, Ig = self.model.currents(points[:, 0], points[:, 1])
+        self.buffers = {
+            "smua.nvbuffer1.timestamps": self.sweep_t,
+            "smub.nvbuffer1.timestamps": self.sweep_t,
+            "smua.nvbuffer1.readings": Id,
+            "smub.nvbuffer1.readings": Ig,
+            "smua.nvbuffer1.sourcevalues": points[:, 1],
+            "smub.nvbuffer1.sourcevalues": points[:, 0],
+        }
+        if len(points):
+            self.voltage = {"a": points[-1, 1], "b": points[-1, 0]}
+            self.source_state["a"].pop("levelv", None)
+            self.source_state["b"].pop("levelv", None)
+
+    def start_sweep(self, points, delay):
+        # upload of a script of about 20 bytes per point
+        self.transfer("write", 20 * len(points) + 1000)
+        step = delay + max(self.integration_time("a"), self.integration_time("b"))
+        self.run_buffered(points, step * np.arange(1, len(points) + 1))
+
+    def start_pulse_train(self, base, delta, delay, width, period, count):
+        check_pulse_timing(
+            delay,
+            width,
+            period,
+            max(self.integration_time("a"), self.integration_time("b")),
+        )
+        self.transfer("write", 2000)
+        point = [base[0] + delta[0], base[1] + delta[1]]
+        self.run_buffered([point] * count, delay + width + period * np.arange(count))
+        self.voltage = {"a": base[1], "b": base[0]}
+
+    def sweep_count(self):
+        self.query("print(math.min(smua.nvbuffer1.n, smub.nvbuffer1.n))")
+        elapsed = time.perf_counter() - self.sweep_start
+        return int(np.searchsorted(self.sweep_t, elapsed, side="right"))
+
+    def read_buffers(self, start, end, buffers):
+        """
+        Read the `buffers` (e.g. "smua.nvbuffer1.readings") from `start` to
+        `end` (1-based, inclusive), returns an array with one column per
+        buffer
+        """
+        n = max(end - start + 1, 0)
+        self.query(
+            f"printbuffer({start}, {end}, {', '.join(buffers)})", 8 * n * len(buffers)
+        )
+        return np.column_stack([self.buffers[b][start - 1 : end] for b in buffers])
+
+    def read_sweep(self, start, end):
+        data = self.read_buffers(
+            start,
+            end,
+            [
+                "smua.nvbuffer1.timestamps",
+                "smua.nvbuffer1.readings",
+                "smub.nvbuffer1.readings",
+            ],
+        )
+        return data[:, 0], data[:, 1], data[:, 2]
+
+    def abort_sweep(self):
+        self.write("smua.abort()\nsmub.abort()")
+        self.sweep_t = self.sweep_t[: self.sweep_count()]
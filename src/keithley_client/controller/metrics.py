@@ -0,0 +1,203 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+class LoopMetrics:
+    """
+    Health of the acquisition loop: achieved sample rate and period jitter
+    over the last WINDOW samples, time spent sleeping
+
+    `period` is the configured sampling period (s), the jitter is the
+    deviation of the intervals between samples from it (from their median
+    without period).
+    """
+
+    WINDOW = 1000
+
+    def __init__(self, period=None):
+        self.reset(period)
+
+    def reset(self, period=None):
+        self.period = period
+        self.start = time.perf_counter()
+        self.samples = 0
+        self.sleep_time = 0
+        self.times = deque(maxlen=self.WINDOW + 1)
+
+    def add_samples(self, t):
+        """
+        Add the times (s) of new samples
+        """
+        self.samples += len(t)
+        self.times.extend(t[-self.times.maxlen :])
+
+    @contextmanager
+    def sleeping(self):
+        """
+        Count the time spent in the block as sleep
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.sleep_time += time.perf_counter() - start
+
+    def snapshot(self, io_time=0):
+        """
+        Metrics as a dict, `io_time` is the time (s) spent in instrument calls
+        since the reset
+        """
+        elapsed = time.perf_counter() - self.start
+        times = np.array(self.times)
+        intervals = np.diff(times)
+        achieved_rate = None
+        jitter = [None, None]
+        if len(intervals) and times[-1] > times[0]:
+            achieved_rate = len(intervals) / (times[-1] - times[0])
+            reference = self.period if self.period else np.median(intervals)
+            deviation = np.abs(intervals - reference)
+            jitter = [float(q) for q in np.percentile(deviation, [50, 99])]
+        return {
+            "elapsed": elapsed,
+            "samples": self.samples,
+            "configured_rate": 1 / self.period if self.period else None,
+            "achieved_rate": achieved_rate,
+            "jitter_p50": jitter[0],
+            "jitter_p99": jitter[1],
+            "sleep_time": self.sleep_time,
+            "io_time": io_time,
+            "sleep_fraction": self.sleep_time / elapsed if elapsed else 0,
+            "io_fraction": io_time / elapsed if elapsed else 0,
+        }
+
+
+# Prometheus name, type and help of the metrics of the snapshots
+PROMETHEUS_METRICS = {
+    "recording": ("keithley_recording", "gauge", "1 while a measurement runs"),
+    "elapsed": (
+        "keithley_elapsed_seconds",
+        "gauge",
+        "Time since the start of the measurement",
+    ),
+    "samples": (
+        "keithley_samples_total",
+        "counter",
+        "Samples recorded since the start of the measurement",
+    ),
+    "configured_rate": (
+        "keithley_configured_rate_hertz",
+        "gauge",
+        "Configured sample rate",
+    ),
+    "achieved_rate": (
+        "keithley_achieved_rate_hertz",
+        "gauge",
+        "Sample rate over the last samples",
+    ),
+    "jitter_p50": (
+        'keithley_period_jitter_seconds{quantile="0.5"}',
+        "gauge",
+        "Deviation of the sampling intervals from the period",
+    ),
+    "jitter_p99": ('keithley_period_jitter_seconds{quantile="0.99"}', "gauge", ""),
+    "sleep_time": (
+        "keithley_sleep_seconds_total",
+        "counter",
+        "Time spent sleeping by the acquisition loop",
+    ),
+    "io_time": (
+        "keithley_io_seconds_total",
+        "counter",
+        "Time spent in instrument calls",
+    ),
+    "missed_periods": (
+        "keithley_missed_periods_total",
+        "counter",
+        "Sampling periods skipped because the loop was late",
+    ),
+    "late_samples": (
+        "keithley_late_samples_total",
+        "counter",
+        "Samples taken late",
+    ),
+    "dropped": (
+        "keithley_dropped_samples_total",
+        "counter",
+        "Samples lost before being read",
+    ),
+    "backlog": (
+        "keithley_backlog",
+        "gauge",
+        "Samples or signals waiting to be handled by the consumer",
+    ),
+    "buffer_bytes": (
+        "keithley_buffer_bytes",
+        "gauge",
+        "Memory of the sample buffers",
+    ),
+}
+
+
+def prometheus_text(snapshot):
+    """
+    Prometheus text exposition of a metrics snapshot, the metrics without a
+    value are left out
+    """
+    lines = []
+    for key, (name, kind, description) in PROMETHEUS_METRICS.items():
+        value = snapshot.get(key)
+        if value is None:
+            continue
+        family = name.split("{")[0]
+        if description:
+            lines.append(f"# HELP {family} {description}")
+            lines.append(f"# TYPE {family} {kind}")
+        lines.append(f"{name} {float(value):.9g}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    HTTP server publishing `snapshot()` in the Prometheus text format on
+    /metrics, from a background thread
+
+    Listens on localhost by default, the metrics are not meant to be exposed
+    to the network.
+    """
+
+    def __init__(self, snapshot, port=9464, host="127.0.0.1"):
+        self.snapshot = snapshot
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = prometheus_text(server.snapshot()).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def address(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
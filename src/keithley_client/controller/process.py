@@ -0,0 +1,350 @@
+import multiprocessing
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .engine import AcquisitionEngine
+
+
+class AcquisitionError(Exception):
+    """
+    Acquisition process not running: it could not open the instrument or
+    has exited
+    """
+
+
+class SharedRing:
+    """
+    Ring of samples in shared memory, written by one process and read by
+    another
+
+    The layout is the one of a `ColumnStore` ring: sample g is stored at
+    g % capacity and g % capacity + capacity, after a header holding the
+    number of samples written. The memory is created if `name` is None,
+    attached otherwise.
+    """
+
+    def __init__(self, columns, capacity=65536, name=None):
+        self.columns = list(columns)
+        self.capacity = capacity
+        create = name is None
+        size = 8 * (1 + 2 * len(self.columns) * capacity)
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        self.header = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf)
+        self.data = np.ndarray(
+            (len(self.columns), 2 * capacity), buffer=self.shm.buf, offset=8
+        )
+        if create:
+            self.header[0] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def nbytes(self):
+        return self.shm.size
+
+    @property
+    def total(self):
+        """
+        Number of samples written
+        """
+        return int(self.header[0])
+
+    def write(self, values):
+        """
+        Write samples, `values` maps the column names to sequences of the
+        same length
+        """
+        n = len(next(iter(values.values())))
+        if n == 0:
+            return
+        total = self.total
+        m = min(n, self.capacity)
+        idx = (total + n - m + np.arange(m)) % self.capacity
+        for i, name in enumerate(self.columns):
+            column = np.asarray(values[name], dtype=float)[-m:]
+            self.data[i, idx] = column
+            self.data[i, idx + self.capacity] = column
+        # published once the samples are written
+        self.header[0] = total + n
+
+    def read(self, start):
+        """
+        Copies of the samples written from the sample `start`, returns the
+        index of the first sample read (later than `start` if the older
+        samples have been overwritten) and a dict mapping the column names to
+        arrays
+        """
+        total = self.total
+        first = max(start, total - self.capacity)
+        offset = first % self.capacity
+        data = self.data[:, offset : offset + total - first].copy()
+        # drop the samples overwritten by the writer during the copy
+        overwritten = max(self.total - self.capacity - first, 0)
+        first += overwritten
+        data = data[:, overwritten:]
+        return first, dict(zip(self.columns, data))
+
+    def close(self):
+        # the arrays must be released before the memory
+        self.header = None
+        self.data = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def serve(
+    conn,
+    ring_name,
+    capacity,
+    keithley_address,
+    dummy,
+    reset,
+    transcript,
+    verify,
+    dummy_options,
+):
+    """
+    Main function of the acquisition process: runs an `AcquisitionEngine`
+    driven by the commands received on `conn` and writes the samples to the
+    shared ring
+
+    Commands are (command, arguments) tuples:
+    - ("start", kwargs of AcquisitionEngine.start)
+    - ("stop", None)
+    - ("stats", None): ("stats", AcquisitionEngine.command_stats()) is sent
+      back
+    - ("metrics", None): ("metrics", AcquisitionEngine.loop_metrics()) is
+      sent back
+    - ("close", None)
+    ("ended", scheduler) is sent back at the end of each measurement, after
+    ("error", message) if it failed. If the instrument cannot be opened,
+    ("error", message) and ("ended", None) are sent and the process exits.
+    """
+    # the messages are sent from this thread and from the forward thread
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    ring = SharedRing(AcquisitionEngine.COLUMNS, capacity, name=ring_name)
+    try:
+        engine = AcquisitionEngine(
+            keithley_address,
+            dummy=dummy,
+            reset=reset,
+            transcript=transcript,
+            verify=verify,
+            dummy_options=dummy_options,
+        )
+    except Exception as e:
+        send(("error", f"Cannot open {keithley_address}: {e!r}"))
+        send(("ended", None))
+        ring.close()
+        return
+    thread = None
+
+    def forward(settings):
+        try:
+            for samples in engine.iter_samples(**settings):
+                ring.write(samples)
+            engine.wait()
+        except Exception as e:
+            send(("error", repr(e)))
+        send(("ended", engine.scheduler))
+
+    while True:
+        command, args = conn.recv()
+        if command == "start":
+            if thread is not None and thread.is_alive():
+                engine.stop()
+                thread.join()
+            thread = threading.Thread(target=forward, args=(args,), daemon=True)
+            thread.start()
+        elif command == "stop":
+            engine.stop()
+        elif command == "stats":
+            send(("stats", engine.command_stats()))
+        elif command == "metrics":
+            send(("metrics", engine.loop_metrics()))
+        elif command == "close":
+            break
+
+    if thread is not None and thread.is_alive():
+        engine.stop()
+        thread.join()
+    engine.close()
+    ring.close()
+
+
+class AcquisitionProcess:
+    """
+    `AcquisitionEngine` running in a child process, so that the sample timing
+    does not depend on the load of this process (e.g. plotting)
+
+    The commands are sent through a pipe and the samples are read from a
+    `SharedRing` holding the last `capacity` samples: call `read` often
+    enough to get them all, the samples overwritten before being read are
+    counted in `dropped`.
+    """
+
+    CAPACITY = 1 << 16
+
+    def __init__(
+        self,
+        keithley_address,
+        dummy=False,
+        reset=True,
+        transcript=None,
+        verify=False,
+        dummy_options=None,
+        capacity=None,
+    ):
+        self.ring = SharedRing(AcquisitionEngine.COLUMNS, capacity or self.CAPACITY)
+        # spawn: the child does not inherit the state of this process (Qt)
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=serve,
+            args=(
+                child_conn,
+                self.ring.name,
+                self.ring.capacity,
+                keithley_address,
+                dummy,
+                reset,
+                transcript,
+                verify,
+                dummy_options,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+        self.read_index = 0
+        self.dropped = 0
+        self.recording = False
+        self.scheduler = None
+        self.stats = None
+        self.metrics = None
+        # message of the last error of the acquisition process
+        self.error = None
+        self.closed = False
+
+    def start(self, **settings):
+        """
+        Start a measurement, `settings` are the arguments of
+        `AcquisitionEngine.start`
+
+        Raises AcquisitionError if the acquisition process is not running.
+        """
+        if not self.send("start", settings):
+            # get the error sent before exiting
+            self.poll()
+            raise AcquisitionError(
+                self.error or "The acquisition process is not running"
+            )
+        self.read_index = self.ring.total
+        self.dropped = 0
+        self.scheduler = None
+        self.error = None
+        self.recording = True
+
+    def send(self, message, args=None):
+        """
+        Send a command to the acquisition process, returns False if it is not
+        running
+        """
+        if self.closed or not self.process.is_alive():
+            return False
+        try:
+            self.conn.send((message, args))
+        except OSError:
+            return False
+        return True
+
+    def stop(self):
+        self.send("stop")
+
+    def request_stats(self):
+        """
+        Ask for the command statistics of the acquisition process, stored in
+        `stats` by `poll` when received
+        """
+        self.send("stats")
+
+    def request_metrics(self):
+        """
+        Ask for the loop metrics of the acquisition process, stored in
+        `metrics` by `poll` when received
+        """
+        self.send("metrics")
+
+    def read(self):
+        """
+        Samples written since the last read, as a dict mapping the column
+        names to arrays
+        """
+        first, values = self.ring.read(self.read_index)
+        self.dropped += first - self.read_index
+        self.read_index = first + len(values[self.ring.columns[0]])
+        return values
+
+    def poll(self):
+        """
+        Handle the messages of the acquisition process, returns True if the
+        measurement has ended, also when the process has exited (False once
+        closed)
+        """
+        if self.closed:
+            return False
+        ended = False
+        # checked first: the messages sent before exiting are read below
+        exited = not self.process.is_alive()
+        while self.conn.poll():
+            try:
+                message, args = self.conn.recv()
+            except (EOFError, OSError):
+                # the process has exited (the pipe may be reset if it had
+                # not read all the commands)
+                exited = True
+                break
+            if message == "ended":
+                self.recording = False
+                self.scheduler = args
+                ended = True
+            elif message == "error":
+                self.error = args
+            elif message == "stats":
+                self.stats = args
+            elif message == "metrics":
+                self.metrics = args
+        if exited and self.recording:
+            # the acquisition process died during the measurement
+            self.recording = False
+            self.error = self.error or "The acquisition process has exited"
+            ended = True
+        return ended
+
+    def close(self, timeout=5):
+        if self.closed:
+            return
+        try:
+            self.conn.send(("close", None))
+        except OSError:
+            pass
+        self.closed = True
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+        self.ring.close()
+        self.ring.unlink()
+        self.recording = False
+        self.stats = None
+        self.metrics = None
@@ -1,182 +1,196 @@
-import time
-from collections import deque
-
-import numpy as np
 import pandas
-from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+
+from .buffer import ColumnStore
+from .engine import AcquisitionEngine, check_settings
+from .process import AcquisitionError, AcquisitionProcess
+
 
-from .keithley import Keithley
-from .keithley_dummy import KeithleyDummy
+class Recorder(QObject):
+    """
+    Qt front-end of `AcquisitionEngine`: the engine callbacks are emitted as
+    signals, delivered in the thread of the receivers
 
+    The attributes and methods of the engine are available on the recorder.
+    """
 
-class Recorder(QThread):
+    # data_ready is emitted at most every PUBLISH_INTERVAL with the samples
+    # recorded in the meantime
     data_ready = pyqtSignal()
     data_ended = pyqtSignal()
 
-    def __init__(self, keithley_address, dummy=False):
+    COLUMNS = AcquisitionEngine.COLUMNS
+
+    def __init__(
+        self,
+        keithley_address,
+        dummy=False,
+        reset=True,
+        transcript=None,
+        verify=False,
+        dummy_options=None,
+    ):
         super().__init__()
-        self.keithley = (
-            KeithleyDummy(keithley_address) if dummy else Keithley(keithley_address)
+        # data_ready signals emitted by the acquisition thread and delivered
+        # to the thread of the recorder
+        self.emitted = 0
+        self.delivered = 0
+        self.data_ready.connect(self.count_delivered)
+        self.engine = AcquisitionEngine(
+            keithley_address,
+            dummy=dummy,
+            reset=reset,
+            on_data=self.publish,
+            on_end=self.data_ended.emit,
+            transcript=transcript,
+            verify=verify,
+            dummy_options=dummy_options,
         )
-        self.keithley.set_source_function("b", "OUTPUT_DCVOLTS")
-        self.keithley.set_source_function("a", "OUTPUT_DCVOLTS")
-        self.points = []
-        self.id = deque()
-        self.ig = deque()
-        self.vd = deque()
-        self.vg = deque()
-        self.time = deque()
-        self.recording = False
-        self.pulse_info = [{"enabled": False}, {"enabled": False}]
-
-    def set_points(self, points):
-        self.points = points
-
-    def start(self, points, delay=1, n_points=1, pulse_info=None):
-        # reset the keithley
-        self.keithley.reset()
-
-        # start the measurement
-        self.keithley.turn_output_on("b")
-        self.keithley.turn_output_on("a")
-
-        self.points = points
-        self.delay = delay
-        self.n_points = n_points
-
-        # Handle pulse information
-        if pulse_info is not None:
-            self.pulse_info = pulse_info
-        else:
-            self.pulse_info = [{"enabled": False}, {"enabled": False}]
-
-        self.recording = True
-        self.process = QThread()
-        self.process.run = self.record
-        self.process.start()
-
-    def get_response_time(self, n_points=1, n=3):
-        # Calculate the response time of the Keithley
-        times = []
-        for _ in range(n):
-            start_time = time.time()
-            for _ in range(n_points):
-                self.keithley.measure_i("a")
-                self.keithley.measure_i("b")
-                self.keithley.source_v_level("a")
-                self.keithley.source_v_level("b")
-            end_time = time.time()
-            times.append(end_time - start_time)
-        return sum(times) / len(times)
-
-    def record(self):
-        self.id.clear()
-        self.ig.clear()
-        self.vd.clear()
-        self.vg.clear()
-        self.time.clear()
-
-        start_time = time.time()
-
-        def measure(n=1):
-            current_time = time.time() - start_time
-            self.time.append(current_time)
-
-            Id = np.zeros(n)
-            Ig = np.zeros(n)
-            Vd = np.zeros(n)
-            Vg = np.zeros(n)
-
-            for i in range(n):
-                Id[i] = self.keithley.measure_i("a")
-                Ig[i] = self.keithley.measure_i("b")
-                Vd[i] = self.keithley.source_v_level("a")
-                Vg[i] = self.keithley.source_v_level("b")
-
-            self.id.append(np.mean(Id))
-            self.ig.append(np.mean(Ig))
-            self.vd.append(np.mean(Vd))
-            self.vg.append(np.mean(Vg))
 
-            self.data_ready.emit()
+    def publish(self):
+        self.emitted += 1
+        self.data_ready.emit()
+
+    def count_delivered(self):
+        self.delivered += 1
+
+    def loop_metrics(self):
+        """
+        Metrics of the acquisition loop (see `AcquisitionEngine.loop_metrics`),
+        the backlog is the number of data_ready signals not delivered yet
+        """
+        metrics = self.engine.loop_metrics()
+        metrics["backlog"] = self.emitted - self.delivered
+        return metrics
+
+    def __getattr__(self, name):
+        if name == "engine":
+            raise AttributeError(name)
+        return getattr(self.engine, name)
+
+
+class ProcessRecorder(QObject):
+    """
+    Qt front-end of `AcquisitionProcess`, with the interface of `Recorder`
 
-        if len(self.points) == 1:
-            [vg_base, vd_base] = self.points[0]
-
-            # Calculate pulse parameters
-            vg_pulse_enabled = self.pulse_info[0].get("enabled", False)
-            vd_pulse_enabled = self.pulse_info[1].get("enabled", False)
-
-            # Extract pulse parameters for Vd and Vg
-            if vd_pulse_enabled:
-                vd_delta = self.pulse_info[1]["delta"]
-                vd_delay = self.pulse_info[1]["delay"]
-
-            if vg_pulse_enabled:
-                vg_delta = self.pulse_info[0]["delta"]
-                vg_delay = self.pulse_info[0]["delay"]
-
-            while self.recording:
-                self.keithley.set_voltage_source("a", vd_base)
-                self.keithley.set_voltage_source("b", vg_base)
-
-                if vg_pulse_enabled or vd_pulse_enabled:
-                    pulse_delay = vg_delay if vg_pulse_enabled else vd_delay
-
-                    time.sleep(pulse_delay)
-
-                    if vd_pulse_enabled:
-                        self.keithley.set_voltage_source("a", vd_base + vd_delta)
-                    if vg_pulse_enabled:
-                        self.keithley.set_voltage_source("b", vg_base + vg_delta)
-
-                    time.sleep(pulse_delay)
-
-                measure(n=self.n_points)
-                if vg_pulse_enabled or vd_pulse_enabled:
-                    if vd_pulse_enabled:
-                        self.keithley.set_voltage_source("a", vd_base)
-                    if vg_pulse_enabled:
-                        self.keithley.set_voltage_source("b", vg_base)
-
-                time.sleep(
-                    self.delay - 2 * pulse_delay if vg_pulse_enabled else self.delay
-                )
-
-        else:
-            # Standard sweep measurement
-            for [vg, vd] in self.points:
-                if not self.recording:
-                    break
-                self.keithley.set_voltage_source("a", vd)
-                self.keithley.set_voltage_source("b", vg)
-                time.sleep(self.delay)
-                self.time.append(time.time() - start_time)
-                self.vg.append(vg)
-                self.vd.append(vd)
-                self.id.append(self.keithley.measure_i("a"))
-                self.ig.append(self.keithley.measure_i("b"))
-                self.data_ready.emit()
-
-        self.data_ended.emit()
+    The acquisition runs in a child process. Every PUBLISH_INTERVAL the new
+    samples are copied from shared memory to `data` and data_ready is
+    emitted.
+    """
+
+    data_ready = pyqtSignal()
+    data_ended = pyqtSignal()
+
+    COLUMNS = AcquisitionEngine.COLUMNS
+    PUBLISH_INTERVAL = AcquisitionEngine.PUBLISH_INTERVAL
+
+    def __init__(
+        self,
+        keithley_address,
+        dummy=False,
+        reset=True,
+        transcript=None,
+        verify=False,
+        dummy_options=None,
+    ):
+        super().__init__()
+        self.process = AcquisitionProcess(
+            keithley_address,
+            dummy=dummy,
+            reset=reset,
+            transcript=transcript,
+            verify=verify,
+            dummy_options=dummy_options,
+        )
+        self.data = ColumnStore(self.COLUMNS)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.poll)
+
+    @property
+    def recording(self):
+        return self.process.recording
+
+    @property
+    def scheduler(self):
+        return self.process.scheduler
+
+    @property
+    def error(self):
+        return self.process.error
+
+    def start(self, max_samples=None, **settings):
+        """
+        Start a measurement, see `AcquisitionEngine.start`
+
+        Raises AcquisitionError if the acquisition process is not running.
+        """
+        # the settings are checked by the engine in the acquisition process,
+        # check them here too to raise the error in the caller
+        check_settings(**settings)
+        self.data = ColumnStore(self.COLUMNS, max_length=max_samples)
+        try:
+            self.process.start(max_samples=max_samples, **settings)
+        except AcquisitionError:
+            # the end of the previous measurement may not have been polled
+            self.timer.stop()
+            raise
+        self.timer.start(int(1000 * self.PUBLISH_INTERVAL))
+
+    def poll(self):
+        ended = self.process.poll()
+        # read after the end message, to get the last samples
+        values = self.process.read()
+        if len(values["Time"]) != 0:
+            self.data.extend(values)
+            self.data_ready.emit()
+        if ended:
+            self.timer.stop()
+            if self.process.dropped:
+                print(f"{self.process.dropped} samples not read from the ring")
+            self.data_ended.emit()
+
+    def command_stats(self):
+        """
+        Last command statistics received from the acquisition process, a new
+        snapshot is requested for the next call
+        """
+        if not self.timer.isActive():
+            # otherwise the messages are handled by poll
+            self.process.poll()
+        self.process.request_stats()
+        return self.process.stats
+
+    def loop_metrics(self):
+        """
+        Last loop metrics received from the acquisition process (see
+        `AcquisitionEngine.loop_metrics`), a new snapshot is requested for the
+        next call
+
+        The backlog includes the samples not read from the shared ring yet,
+        the buffer memory the ring and the samples of this process.
+        """
+        if not self.timer.isActive():
+            self.process.poll()
+        self.process.request_metrics()
+        if self.process.metrics is None:
+            return None
+        metrics = dict(self.process.metrics)
+        ring = self.process.ring
+        metrics["backlog"] += ring.total - self.process.read_index
+        metrics["dropped"] = self.process.dropped
+        metrics["buffer_bytes"] += ring.nbytes + self.data.nbytes
+        return metrics
 
     def stop(self):
-        self.recording = False
-        time.sleep(0.1)
-        self.keithley.turn_output_off("b")
-        self.keithley.turn_output_off("a")
+        self.process.stop()
+
+    def close(self):
+        self.timer.stop()
+        self.process.close()
 
     def save(self, filename, columns=None):
         if columns is None:
             columns = ["Time", "Vg", "Vd", "Id", "Ig"]
-        data = {
-            "Time": self.time,
-            "Vg": self.vg,
-            "Vd": self.vd,
-            "Id": self.id,
-            "Ig": self.ig,
-        }
-        df = pandas.DataFrame(data)
-        df = df[columns]
+        df = pandas.DataFrame(dict(zip(columns, self.data.view(*columns))))
         df.to_csv(filename, index=False, sep="\t")
         return df
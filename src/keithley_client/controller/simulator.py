@@ -0,0 +1,565 @@
+import ast
+import ipaddress
+import re
+import socket
+import socketserver
+import struct
+import sys
+import time
+
+import numpy as np
+
+from .keithley_dummy import INTERFACES, DeviceModel
+
+# Python translation of the Lua constants
+LUA_KEYWORDS = {"true": "True", "false": "False", "nil": "None"}
+
+
+class LuaTable(dict):
+    """
+    Lua table of a sequence, indexed from 1
+    """
+
+    def __init__(self, items=()):
+        super().__init__(enumerate(items, 1))
+
+    def values_list(self):
+        return [self[i] for i in range(1, len(self) + 1)]
+
+
+def ipairs(table):
+    return [(i, table[i]) for i in range(1, len(table) + 1)]
+
+
+def translate_expression(text):
+    text = text.replace("{", "LuaTable([").replace("}", "])")
+    text = re.sub(r"#(\w+)", r"len(\1)", text)
+    text = text.replace("~=", "!=")
+    return re.sub(r"\b(true|false|nil)\b", lambda m: LUA_KEYWORDS[m[1]], text)
+
+
+def translate(lines):
+    """
+    Translate the subset of Lua used by the client (statements, for loops,
+    functions, if blocks) to Python
+    """
+    out = []
+    indent = 0
+
+    def emit(text, level=None):
+        out.append("    " * (indent if level is None else level) + text)
+
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("--"):
+            continue
+        if line == "end":
+            indent -= 1
+            continue
+        if line == "else":
+            emit("else:", indent - 1)
+            continue
+        m = re.fullmatch(r"for (.+?) in (.+?) do(?: (.*) end)?", line)
+        if m:
+            emit(f"for {m[1]} in {translate_expression(m[2])}:")
+            if m[3] is not None:
+                emit(translate_statement(m[3]), indent + 1)
+            else:
+                indent += 1
+            continue
+        m = re.fullmatch(r"(?:local )?function (\w+)\((.*)\)", line)
+        if m:
+            emit(f"def {m[1]}({m[2]}):")
+            indent += 1
+            continue
+        m = re.fullmatch(r"(if|elseif) (.+) then", line)
+        if m:
+            keyword = "if" if m[1] == "if" else "elif"
+            level = indent if keyword == "if" else indent - 1
+            emit(f"{keyword} {translate_expression(m[2])}:", level)
+            if keyword == "if":
+                indent += 1
+            continue
+        emit(translate_statement(line))
+    return "\n".join(out)
+
+
+def translate_statement(text):
+    return translate_expression(text.removeprefix("local "))
+
+
+def check(code):
+    """
+    Refuse the code that could reach Python internals
+
+    This only catches the mistakes of a well-meaning client, it is not a
+    security boundary: the commands run with exec in the simulator process,
+    which must only listen on the loopback interface (see `serve`).
+    """
+    for node in ast.walk(ast.parse(code)):
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.Global, ast.Nonlocal)):
+            raise SyntaxError("unsupported statement")
+        name = getattr(node, "attr", None) or getattr(node, "id", None)
+        if name is not None and name.startswith("__"):
+            raise SyntaxError(f"unsupported name {name}")
+
+
+class Node:
+    """
+    TSP object: attributes are created when they are first read, upper case
+    attributes are constants named after their path (e.g. "smua.OUTPUT_ON")
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name.isupper():
+            return f"{self.path}.{name}"
+        child = Node(f"{self.path}.{name}")
+        setattr(self, name, child)
+        return child
+
+
+class BufferColumn:
+    """
+    Readings, timestamps or source values of a buffer, indexed from 1
+    """
+
+    def __init__(self, buffer, name):
+        self.buffer = buffer
+        self.name = name
+
+    def values(self):
+        return getattr(self.buffer, self.name)[: self.buffer.n]
+
+    def __getitem__(self, i):
+        return float(self.values()[i - 1])
+
+    def __len__(self):
+        return self.buffer.n
+
+
+class Buffer(Node):
+    """
+    Reading buffer, the planned readings become available at their time
+    """
+
+    def __init__(self, path, clock):
+        super().__init__(path)
+        self.clock = clock
+        self.clear()
+
+    def clear(self):
+        self.t = np.zeros(0)
+        self.i = np.zeros(0)
+        self.v = np.zeros(0)
+        self.readings = BufferColumn(self, "i")
+        self.timestamps = BufferColumn(self, "t")
+        self.sourcevalues = BufferColumn(self, "v")
+
+    def extend(self, t, i, v):
+        self.t = np.concatenate([self.t, t])
+        self.i = np.concatenate([self.i, i])
+        self.v = np.concatenate([self.v, v])
+
+    def truncate(self, n):
+        self.t = self.t[:n]
+        self.i = self.i[:n]
+        self.v = self.v[:n]
+
+    @property
+    def n(self):
+        return int(np.searchsorted(self.t, self.clock(), side="right"))
+
+
+class Trigger(Node):
+    def __init__(self, path, smu):
+        super().__init__(path)
+        self.smu = smu
+        self.count = 1
+        self.source.action = f"{smu.path}.DISABLE"
+        self.source.stimulus = 0
+        self.source.list = []
+        self.source.listv = self.listv
+        self.measure.action = f"{smu.path}.DISABLE"
+        self.measure.stimulus = 0
+        self.measure.buffer = None
+        self.measure.i = self.measure_i
+        self.endpulse.action = f"{smu.path}.SOURCE_HOLD"
+        self.endpulse.stimulus = 0
+
+    def listv(self, values):
+        self.source.list = values.values_list()
+
+    def measure_i(self, buffer):
+        self.measure.buffer = buffer
+
+    def initiate(self):
+        self.smu.simulator.initiate(self.smu)
+
+
+class Smu(Node):
+    def __init__(self, name, simulator):
+        super().__init__(name)
+        self.simulator = simulator
+        self.reset()
+
+    def reset(self):
+        clock = self.simulator.clock
+        self.source.func = f"{self.path}.OUTPUT_DCVOLTS"
+        self.source.levelv = 0
+        self.source.leveli = 0
+        self.source.output = f"{self.path}.OUTPUT_OFF"
+        self.measure.nplc = 1
+        self.measure.count = 1
+        self.measure.filter.count = 1
+        self.measure.filter.enable = f"{self.path}.FILTER_OFF"
+        self.measure.i = lambda: self.simulator.measure(self)
+        self.measure.v = lambda: self.simulator.measure_v(self)
+        self.nvbuffer1 = Buffer(f"{self.path}.nvbuffer1", clock)
+        self.nvbuffer2 = Buffer(f"{self.path}.nvbuffer2", clock)
+        self.trigger = Trigger(f"{self.path}.trigger", self)
+        self.plan = None
+
+    def abort(self):
+        self.simulator.abort(self)
+
+    def integration_time(self):
+        n = 1
+        if self.measure.filter.enable == f"{self.path}.FILTER_ON":
+            n = self.measure.filter.count
+        return self.measure.nplc / self.simulator.line_frequency * n
+
+
+class Timer(Node):
+    def __init__(self, path):
+        super().__init__(path)
+        self.reset()
+
+    def reset(self):
+        self.delay = 0
+        self.count = 1
+        self.passthrough = False
+        self.stimulus = 0
+
+
+class Script:
+    def __init__(self, simulator, lines):
+        self.simulator = simulator
+        self.lines = lines
+
+    def run(self):
+        self.simulator.execute(self.lines)
+
+
+class Simulator:
+    """
+    Keithley 2600 interpreting the TSP subset used by the client: source and
+    measure attributes of the SMUs, print/printnumber/printbuffer, reading
+    buffers, scripts and the trigger model patterns of the sweeps, pulse
+    trains and synchronous measurements
+
+    The measurements take the integration time of the SMUs, the trigger
+    model readings become available at the time they would be measured.
+    """
+
+    def __init__(self, seed=None, line_frequency=50):
+        self.model = DeviceModel(seed=seed)
+        self.line_frequency = line_frequency
+        self.output = []
+        self.script = None
+        self.reset()
+
+    def clock(self):
+        """
+        Time (s) since the reset, the buffers are timestamped with it
+        """
+        return time.perf_counter() - self.t0
+
+    def timer_t(self):
+        """
+        Time (s) since `timer.reset()`
+        """
+        return time.perf_counter() - self.timer_start
+
+    def reset(self):
+        self.t0 = time.perf_counter()
+        self.timer_start = self.t0
+        self.smua = Smu("smua", self)
+        self.smub = Smu("smub", self)
+        self.format = Node("format")
+        self.format.data = "format.ASCII"
+        self.format.byteorder = "format.NORMAL"
+        self.format.asciiprecision = 6
+        self.timer = Node("timer")
+        self.timer.reset = self.reset_timer
+        self.timer.measure.t = self.timer_t
+        self.trigger = Node("trigger")
+        self.trigger.timer = {k: Timer(f"trigger.timer[{k}]") for k in range(1, 9)}
+        self.namespace = {
+            "__builtins__": {},
+            "LuaTable": LuaTable,
+            "ipairs": ipairs,
+            "len": len,
+            "smua": self.smua,
+            "smub": self.smub,
+            "format": self.format,
+            "timer": self.timer,
+            "trigger": self.trigger,
+            "beeper": Node("beeper"),
+            "math": Node("math"),
+            "print": self.print,
+            "printnumber": self.printnumber,
+            "printbuffer": self.printbuffer,
+            "waitcomplete": self.waitcomplete,
+        }
+        self.namespace["math"].min = min
+        self.namespace["math"].max = max
+        self.namespace["beeper"].beep = lambda duration, frequency: None
+
+    def reset_timer(self):
+        self.timer_start = time.perf_counter()
+
+    def handle(self, line):
+        """
+        Run a line received from the client, returns the text printed
+        """
+        self.output = []
+        line = line.strip()
+        if self.script is not None:
+            name, lines = self.script
+            if line == "endscript":
+                self.namespace[name] = Script(self, lines)
+                self.script = None
+            else:
+                lines.append(line)
+        elif line.startswith("loadscript "):
+            self.script = (line.split()[1], [])
+        elif line == "*RST":
+            self.reset()
+        elif line == "*IDN?":
+            self.output.append(b"Keithley Instruments Inc., Model 2612B, simulator\n")
+        elif line == "*OPC?":
+            self.output.append(b"1\n")
+        elif line.startswith("*"):
+            pass
+        elif line:
+            self.execute([line])
+        return b"".join(self.output)
+
+    def execute(self, lines):
+        # the client text is executed as Python, not sandboxed by `check`
+        code = translate(lines)
+        check(code)
+        exec(code, self.namespace)
+
+    # Output
+
+    def format_number(self, value):
+        if isinstance(value, str):
+            return value
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if value is None:
+            return "nil"
+        return f"{float(value):.{int(self.format.asciiprecision) - 1}e}"
+
+    def print(self, *values):
+        line = "\t".join(self.format_number(v) for v in values)
+        self.output.append(line.encode() + b"\n")
+
+    def print_numbers(self, values):
+        if self.format.data == "format.ASCII":
+            line = ", ".join(self.format_number(v) for v in values)
+            self.output.append(line.encode() + b"\n")
+        else:
+            order = "<" if self.format.byteorder == "format.LITTLEENDIAN" else ">"
+            data = struct.pack(f"{order}{len(values)}d", *values)
+            self.output.append(b"#0" + data + b"\n")
+
+    def printnumber(self, *values):
+        self.print_numbers([float(v) for v in values])
+
+    def printbuffer(self, start, end, *columns):
+        start, end = int(start), int(end)
+        data = np.column_stack([c.values()[start - 1 : end] for c in columns])
+        self.print_numbers(list(data.ravel()))
+
+    def waitcomplete(self):
+        end = max(
+            [smu.plan["t"][-1] for smu in [self.smua, self.smub] if smu.plan] + [0]
+        )
+        delay = end - self.clock()
+        if delay > 0:
+            time.sleep(delay)
+
+    # Measurements
+
+    def currents(self, vg, vd, smu):
+        Id, Ig = self.model.currents(vg, vd)
+        return Id if smu is self.smua else Ig
+
+    def measure(self, smu):
+        time.sleep(smu.integration_time())
+        if smu.source.output != f"{smu.path}.OUTPUT_ON":
+            return 0.0
+        return float(
+            self.currents(self.smub.source.levelv, self.smua.source.levelv, smu)
+        )
+
+    def measure_v(self, smu):
+        time.sleep(smu.integration_time())
+        if smu.source.output != f"{smu.path}.OUTPUT_ON":
+            return 0.0
+        return float(smu.source.levelv)
+
+    def event_time(self, stimulus, i, ready):
+        """
+        Time of the i-th event `stimulus` of the trigger model, `ready` is
+        the time at which the SMU can act
+        """
+        m = re.fullmatch(r"trigger\.timer\[(\d)\]\.EVENT_ID", str(stimulus))
+        if m is None:
+            # immediate, armed or source complete events
+            return ready
+        timer = self.trigger.timer[int(m[1])]
+        source = str(timer.stimulus)
+        if source.endswith("SOURCE_COMPLETE_EVENT_ID"):
+            return ready + timer.delay
+        if source.endswith("ARMED_EVENT_ID"):
+            return (i if timer.passthrough else i + 1) * timer.delay
+        return self.event_time(source, i, ready) + timer.delay
+
+    def initiate(self, smu):
+        """
+        Run the trigger model of `smu`: plan the source levels and the
+        measurement times of the `trigger.count` points
+        """
+        trigger = smu.trigger
+        count = int(trigger.count)
+        levels = trigger.source.list
+        if trigger.source.action != f"{smu.path}.ENABLE" or not levels:
+            levels = [smu.source.levelv]
+        levels = np.resize(np.asarray(levels, dtype=float), count)
+        start = self.clock()
+        meas = smu.integration_time()
+        t = np.zeros(count)
+        ready = 0
+        for i in range(count):
+            source = max(self.event_time(trigger.source.stimulus, i, ready), ready)
+            t[i] = self.event_time(trigger.measure.stimulus, i, source)
+            ready = t[i] + meas
+        smu.plan = {
+            "t": start + t + meas,
+            "v": levels,
+            "buffer": trigger.measure.buffer,
+        }
+        if trigger.endpulse.action == f"{smu.path}.SOURCE_HOLD":
+            smu.source.levelv = float(levels[-1])
+
+        # readings evaluated with the levels of both SMUs, planned or fixed:
+        # the ones of the SMU initiated first are evaluated again when the
+        # second is initiated
+        def levels(s):
+            if s.plan and len(s.plan["v"]) == count:
+                return s.plan["v"]
+            return s.source.levelv
+
+        vg, vd = levels(self.smub), levels(self.smua)
+        for s in [self.smua, self.smub]:
+            plan = s.plan
+            if plan and plan["buffer"] is not None and len(plan["v"]) == count:
+                buffer = plan["buffer"]
+                if "n0" not in plan:
+                    plan["n0"] = len(buffer.t)
+                buffer.truncate(plan["n0"])
+                Id = self.currents(vg, vd, s)
+                buffer.extend(plan["t"], np.broadcast_to(Id, (count,)), plan["v"])
+
+    def abort(self, smu):
+        if smu.plan and smu.plan["buffer"] is not None:
+            buffer = smu.plan["buffer"]
+            buffer.truncate(buffer.n)
+        smu.plan = None
+
+
+class SimulatorHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        simulator = self.server.simulator
+        latency = self.server.latency
+        pending = b""
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                break
+            self.server.wait(latency["write"], len(data))
+            *lines, pending = (pending + data).split(b"\n")
+            reply = b""
+            for line in lines:
+                try:
+                    reply += simulator.handle(line.decode(errors="replace"))
+                except Exception as e:
+                    print(
+                        f"Error: {line.decode(errors='replace')}: {e}", file=sys.stderr
+                    )
+            if reply:
+                self.server.wait(latency["query"], len(reply))
+                self.request.sendall(reply)
+
+
+class SimulatorServer(socketserver.TCPServer):
+    """
+    TCP server of a `Simulator`, one client at a time, with the latency of
+    `interface` (see `keithley_dummy.INTERFACES`)
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self, address, interface="none", seed=None):
+        super().__init__(address, SimulatorHandler)
+        self.simulator = Simulator(seed=seed)
+        self.latency = INTERFACES[interface]
+        self.rng = np.random.default_rng(seed)
+
+    def wait(self, latency, nbytes):
+        mean, jitter = latency
+        duration = mean + nbytes * self.latency["byte"]
+        if jitter:
+            duration += self.rng.normal(0, jitter)
+        if duration > 0:
+            time.sleep(duration)
+
+
+def is_loopback(host):
+    """
+    Whether all the addresses of `host` are loopback addresses
+    """
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(info[4][0]).is_loopback for info in infos)
+
+
+def serve(host="127.0.0.1", port=5025, interface="none", seed=None):
+    """
+    Run the simulator at `host`:`port` until interrupted, the client address
+    is TCPIP::<host>::<port>::SOCKET
+
+    The simulator executes the commands it receives as Python code, so
+    `host` must be a loopback address, otherwise ValueError is raised.
+    """
+    if not is_loopback(host):
+        raise ValueError(
+            f"The simulator executes the commands it receives, it only listens "
+            f"on a loopback address, not {host}"
+        )
+    with SimulatorServer((host, port), interface, seed) as server:
+        print(f"Simulator listening on TCPIP::{host}::{port}::SOCKET")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
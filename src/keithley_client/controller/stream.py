@@ -0,0 +1,91 @@
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class StreamWriter:
+    """
+    Append samples to a file from a background thread while recording
+
+    Samples queued with `write` are written in chunks, every `chunk_size`
+    samples or every `interval` seconds. Each chunk is flushed and synced to
+    disk, so the file is valid at every chunk boundary. Formats:
+    - "tsv": tab separated table with a header, like `Recorder.save`
+    - "bin": float64 little-endian rows, the column names are saved in the
+      `<filename>.json` sidecar
+    """
+
+    def __init__(self, filename, columns, fmt="tsv", chunk_size=1000, interval=1.0):
+        self.filename = filename
+        self.columns = list(columns)
+        self.fmt = fmt
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.rows = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        if self.fmt == "tsv":
+            self.file = open(self.filename, "w")
+            self.file.write("\t".join(self.columns) + "\n")
+        else:
+            with open(self.filename + ".json", "w") as f:
+                json.dump({"columns": self.columns, "dtype": "<f8"}, f)
+            self.file = open(self.filename, "wb")
+        self.sync()
+        self.thread.start()
+
+    def write(self, values):
+        """
+        Queue samples, `values` maps the column names to sequences
+        """
+        self.queue.put(
+            np.column_stack([np.asarray(values[c], dtype=float) for c in self.columns])
+        )
+
+    def close(self):
+        """
+        Write the queued samples and close the file
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+    def run(self):
+        chunks = []
+        n = 0
+        last = time.monotonic()
+        closing = False
+        while not closing:
+            try:
+                chunk = self.queue.get(timeout=self.interval)
+                if chunk is None:
+                    closing = True
+                else:
+                    chunks.append(chunk)
+                    n += len(chunk)
+            except queue.Empty:
+                pass
+            due = n >= self.chunk_size or time.monotonic() - last >= self.interval
+            if chunks and (closing or due):
+                self.write_chunk(np.concatenate(chunks))
+                chunks = []
+                n = 0
+                last = time.monotonic()
+
+    def write_chunk(self, rows):
+        if self.fmt == "tsv":
+            np.savetxt(self.file, rows, delimiter="\t", fmt="%.15g")
+        else:
+            self.file.write(rows.astype("<f8").tobytes())
+        self.sync()
+        self.rows += len(rows)
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
@@ -0,0 +1,155 @@
+import gzip
+import json
+import threading
+import time
+
+import pyvisa
+
+
+class TranscriptMismatch(Exception):
+    """
+    Call differing from the one of the transcript being replayed
+    """
+
+
+def open_transcript(filename, mode="r"):
+    """
+    Open a transcript file as text, gzip compressed if it ends with .gz
+    """
+    if filename.endswith(".gz"):
+        return gzip.open(filename, mode + "t", encoding="utf-8")
+    return open(filename, mode, encoding="utf-8")
+
+
+def load_transcript(filename):
+    """
+    List of the calls of a transcript, see `TranscriptRecorder`
+    """
+    with open_transcript(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class TranscriptRecorder:
+    """
+    VISA session wrapper writing every call to a transcript file
+
+    The transcript has one JSON object per line:
+    - "op": "write", "query" or "query_binary_values"
+    - "command": the command sent
+    - "reply": the reply (list of numbers for binary values)
+    - "error": VISA error code, if the call failed
+    - "t": start of the call (ns since the transcript was opened)
+    - "dt": duration of the call (ns)
+    Timings come from `time.perf_counter_ns`.
+    """
+
+    def __init__(self, session, filename):
+        self.session = session
+        self.filename = filename
+        self.file = open_transcript(filename, "w")
+        self.lock = threading.Lock()
+        self.t0 = time.perf_counter_ns()
+
+    def call(self, op, command, *args, **kwargs):
+        start = time.perf_counter_ns()
+        entry = {"op": op, "command": command}
+        try:
+            reply = getattr(self.session, op)(command, *args, **kwargs)
+        except pyvisa.errors.VisaIOError as e:
+            entry["error"] = e.error_code
+            raise
+        else:
+            if op == "query_binary_values":
+                entry["reply"] = [float(v) for v in reply]
+            elif op == "query":
+                entry["reply"] = reply
+            return reply
+        finally:
+            end = time.perf_counter_ns()
+            entry["t"] = start - self.t0
+            entry["dt"] = end - start
+            with self.lock:
+                self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def write(self, command):
+        return self.call("write", command)
+
+    def query(self, command):
+        return self.call("query", command)
+
+    def query_binary_values(self, command, **kwargs):
+        return self.call("query_binary_values", command, **kwargs)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        self.session.close()
+
+
+class TranscriptReplay:
+    """
+    VISA session replaying a transcript written by `TranscriptRecorder`
+
+    The calls must come in the order of the transcript, with the same
+    commands, otherwise `TranscriptMismatch` is raised. A call that is not
+    the next one waits up to MISMATCH_TIMEOUT for other threads to make the
+    calls recorded before it (e.g. the outputs turned off by `stop` while
+    the acquisition thread reads the instrument).
+
+    With `realtime`, each call takes the duration it took when recorded, so
+    that the time spent by the client between the calls can be compared
+    with the original run; otherwise the replies are returned at once.
+    """
+
+    MISMATCH_TIMEOUT = 1
+
+    def __init__(self, filename, realtime=True):
+        self.filename = filename
+        self.realtime = realtime
+        self.entries = load_transcript(filename)
+        self.position = 0
+        self.condition = threading.Condition()
+
+    def matches(self, op, command):
+        if self.position >= len(self.entries):
+            return False
+        entry = self.entries[self.position]
+        return entry["op"] == op and entry["command"] == command
+
+    def call(self, op, command):
+        start = time.perf_counter_ns()
+        with self.condition:
+            if not self.condition.wait_for(
+                lambda: self.matches(op, command), self.MISMATCH_TIMEOUT
+            ):
+                if self.position >= len(self.entries):
+                    raise TranscriptMismatch(
+                        f"{op}({command!r}) after the end of the transcript"
+                    )
+                entry = self.entries[self.position]
+                raise TranscriptMismatch(
+                    f"call {self.position + 1}: {op}({command!r}), "
+                    f"expected {entry['op']}({entry['command']!r})"
+                )
+            entry = self.entries[self.position]
+            self.position += 1
+            self.condition.notify_all()
+        if self.realtime:
+            remaining = entry["dt"] - (time.perf_counter_ns() - start)
+            if remaining > 0:
+                time.sleep(remaining / 1e9)
+        if "error" in entry:
+            raise pyvisa.errors.VisaIOError(entry["error"])
+        return entry.get("reply")
+
+    def write(self, command):
+        self.call("write", command)
+
+    def query(self, command):
+        return self.call("query", command)
+
+    def query_binary_values(self, command, container=list, **kwargs):
+        return container(self.call("query_binary_values", command))
+
+    def close(self):
+        pass
@@ -1,8 +1,10 @@
 import json
+import math
 import os
 
 import numpy as np
 from platformdirs import user_data_dir
+from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import (
     QCheckBox,
     QComboBox,
@@ -12,17 +14,30 @@ from PyQt5.QtWidgets import (
     QGroupBox,
     QLabel,
     QMainWindow,
+    QMessageBox,
     QPushButton,
     QSizePolicy,
     QSpacerItem,
     QSpinBox,
+    QTableWidget,
+    QTableWidgetItem,
     QWidget,
 )
 from pyqtgraph import GraphicsLayoutWidget
 
-from ..config import CONFIGS, KEITHLEY_ADDRESS
-from ..controller.recorder import Recorder
+from ..config import (
+    CONFIGS,
+    KEITHLEY_ADDRESS,
+    SPEED_PROFILES,
+    STREAM_MAX_SAMPLES,
+)
+from ..controller.engine import measurement_settings, saving_columns
+from ..controller.keithley import integration_time
+from ..controller.metrics import MetricsServer
+from ..controller.process import AcquisitionError
+from ..controller.recorder import ProcessRecorder, Recorder
 from ..utils import float_to_eng_string
+from ..utils.decimation import MinMaxPyramid
 
 user_dir = user_data_dir(appname="keithley_client", appauthor=False)
 
@@ -50,7 +65,23 @@ class MainWindow(QMainWindow):
     Main window
     """
 
-    def __init__(self, win_title, mode, dummy=False):
+    # Plot refresh rate (frames per second)
+    FRAME_RATE = 30
+    # Refresh interval (ms) of the command timing panel and of the loop metrics
+    STATS_INTERVAL = 1000
+
+    def __init__(
+        self,
+        win_title,
+        mode,
+        dummy=False,
+        reset=True,
+        process=False,
+        transcript=None,
+        metrics_port=None,
+        verify=False,
+        dummy_options=None,
+    ):
         super().__init__()
 
         self.win_title = win_title
@@ -76,12 +107,44 @@ class MainWindow(QMainWindow):
                 print("No default configuration found, loading hardcoded configuration")
                 self.configs = CONFIGS
 
-        self.recorder = Recorder(KEITHLEY_ADDRESS, dummy=dummy)
-        self.recorder.data_ready.connect(self.update_plots)
+        # With process, the acquisition runs in a child process and is not
+        # slowed down by the plots
+        recorder = ProcessRecorder if process else Recorder
+        self.recorder = recorder(
+            KEITHLEY_ADDRESS,
+            dummy=dummy,
+            reset=reset,
+            transcript=transcript,
+            verify=verify,
+            dummy_options=dummy_options,
+        )
         self.recorder.data_ended.connect(self.stop)
 
+        # The plots are redrawn at a fixed frame rate with the data recorded
+        # since the last frame, whatever the sample rate
+        self.drawn = None
+        # Min/max pyramids of the time series, to draw only the visible points
+        self.pyramids = {}
+        self.pyramids_data = None
+
         self.init_ui()
 
+        self.plot_items[0].sigXRangeChanged.connect(self.view_changed)
+        self.frame_timer = QTimer(self)
+        self.frame_timer.timeout.connect(self.refresh)
+        self.frame_timer.start(int(1000 / self.FRAME_RATE))
+        # Loop metrics, published on localhost with metrics_port
+        self.metrics = None
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = MetricsServer(
+                lambda: self.metrics or {}, metrics_port
+            )
+            print(f"Metrics published on {self.metrics_server.address}")
+        self.stats_timer = QTimer(self)
+        self.stats_timer.timeout.connect(self.update_metrics)
+        self.stats_timer.start(self.STATS_INTERVAL)
+
     def init_ui(self):
         """
         Initialize the user interface
@@ -132,8 +195,8 @@ class MainWindow(QMainWindow):
 
         self.Vg_pulse_delay_label = QLabel("Delay (s)")
         self.Vg_pulse_delay_spin = QDoubleSpinBox()
-        self.Vg_pulse_delay_spin.setDecimals(2)
-        self.Vg_pulse_delay_spin.setRange(0.01, 10)
+        self.Vg_pulse_delay_spin.setDecimals(4)
+        self.Vg_pulse_delay_spin.setRange(0.0001, 10)
         self.Vg_pulse_delay_spin.setSingleStep(0.01)
 
         self.Vg_start_label = QLabel("Start value (V)")
@@ -189,8 +252,8 @@ class MainWindow(QMainWindow):
 
         self.Vd_pulse_delay_label = QLabel("Delay (s)")
         self.Vd_pulse_delay_spin = QDoubleSpinBox()
-        self.Vd_pulse_delay_spin.setDecimals(2)
-        self.Vd_pulse_delay_spin.setRange(0.01, 10)
+        self.Vd_pulse_delay_spin.setDecimals(4)
+        self.Vd_pulse_delay_spin.setRange(0.0001, 10)
         self.Vd_pulse_delay_spin.setSingleStep(0.01)
 
         self.Vd_start_label = QLabel("Start value (V)")
@@ -286,6 +349,15 @@ class MainWindow(QMainWindow):
         self.n_points_spin.setValue(1)
         self.n_points_spin.setSingleStep(1)
 
+        self.instrument_sweep_checkbox = QCheckBox(
+            "Run sweeps and pulses on the instrument"
+        )
+
+        self.profile_label = QLabel("Speed")
+        self.profile_combo = QComboBox()
+        for profile in SPEED_PROFILES:
+            self.profile_combo.addItem(profile)
+
         self.measurement_layout.addWidget(self.Y1_axis_checkbox, 0, 0)
         self.measurement_layout.addWidget(self.Y1_combo, 1, 0)
         self.measurement_layout.addWidget(self.Y2_axis_checkbox, 0, 1)
@@ -296,6 +368,9 @@ class MainWindow(QMainWindow):
         self.measurement_layout.addWidget(self.delay_spin, 1, 3)
         self.measurement_layout.addWidget(self.n_points_label, 0, 4)
         self.measurement_layout.addWidget(self.n_points_spin, 1, 4)
+        self.measurement_layout.addWidget(self.instrument_sweep_checkbox, 2, 0, 1, 3)
+        self.measurement_layout.addWidget(self.profile_label, 2, 3)
+        self.measurement_layout.addWidget(self.profile_combo, 2, 4)
 
         # Start/stop and save buttons group
         self.buttons_group = QGroupBox("Actions")
@@ -315,12 +390,16 @@ class MainWindow(QMainWindow):
         self.column_Vd_checkbox = QCheckBox("Vd")
         self.column_Id_checkbox = QCheckBox("Id")
         self.column_Ig_checkbox = QCheckBox("Ig")
+        self.column_host_time_checkbox = QCheckBox("Host time")
+        self.stream_checkbox = QCheckBox("Stream to file while recording")
 
         self.columns_layout.addWidget(self.column_time_checkbox, 0, 0)
         self.columns_layout.addWidget(self.column_Vg_checkbox, 0, 1)
         self.columns_layout.addWidget(self.column_Vd_checkbox, 0, 2)
         self.columns_layout.addWidget(self.column_Id_checkbox, 0, 3)
         self.columns_layout.addWidget(self.column_Ig_checkbox, 0, 4)
+        self.columns_layout.addWidget(self.column_host_time_checkbox, 0, 5)
+        self.columns_layout.addWidget(self.stream_checkbox, 1, 0, 1, 6)
 
         self.buttons_layout.addWidget(self.start_button, 0, 0)
         self.buttons_layout.addWidget(self.stop_button, 0, 1)
@@ -376,6 +455,40 @@ class MainWindow(QMainWindow):
         self.plot_layout.addWidget(self.show_last_seconds_checkbox, 1, 0)
         self.plot_layout.addWidget(self.show_last_seconds_spin, 1, 1)
 
+        # Command timing group, hidden while unchecked
+        self.stats_group = QGroupBox("Command timing")
+        self.stats_group.setCheckable(True)
+        self.stats_group.setChecked(False)
+        self.stats_layout = QGridLayout()
+        self.stats_group.setLayout(self.stats_layout)
+
+        self.stats_label = QLabel("")
+        self.loop_label = QLabel("")
+        self.stats_save_button = QPushButton("Save JSON")
+        self.stats_table = QTableWidget(0, 8)
+        self.stats_table.setHorizontalHeaderLabels(
+            [
+                "Command",
+                "Calls",
+                "Total (s)",
+                "Mean (ms)",
+                "p50 (ms)",
+                "p99 (ms)",
+                "Max (ms)",
+                "Bytes out/in",
+            ]
+        )
+        self.stats_table.verticalHeader().setVisible(False)
+        self.stats_table.horizontalHeader().setStretchLastSection(True)
+        self.stats_table.setMaximumHeight(200)
+
+        self.stats_layout.addWidget(self.stats_label, 0, 0)
+        self.stats_layout.addWidget(self.stats_save_button, 0, 1)
+        self.stats_layout.addWidget(self.loop_label, 1, 0, 1, 2)
+        self.stats_layout.addWidget(self.stats_table, 2, 0, 1, 2)
+        self.stats_layout.setColumnStretch(0, 1)
+        self.show_command_stats(False)
+
         # Main layout
         self.layout = QGridLayout()
         self.layout.addWidget(self.mode_group, 0, 0)
@@ -387,6 +500,7 @@ class MainWindow(QMainWindow):
         )
         self.layout.addWidget(self.info_group, 5, 0)
         self.layout.addWidget(self.plot_group, 0, 1, 6, 2)
+        self.layout.addWidget(self.stats_group, 6, 0, 1, 3)
         self.layout.setColumnStretch(1, 2)
 
         self.central_widget = QWidget()
@@ -501,10 +615,20 @@ class MainWindow(QMainWindow):
         self.n_points_spin.valueChanged.connect(
             lambda: self.update_config("n_points", self.n_points_spin.value())
         )
+        self.profile_combo.currentIndexChanged.connect(
+            lambda: self.update_config("profile", self.profile_combo.currentText())
+        )
+        self.instrument_sweep_checkbox.stateChanged.connect(
+            lambda: self.update_config(
+                "instrument_sweep", self.instrument_sweep_checkbox.isChecked()
+            )
+        )
 
         self.start_button.clicked.connect(self.start)
         self.stop_button.clicked.connect(self.stop)
         self.save_button.clicked.connect(self.save)
+        self.stats_group.toggled.connect(self.show_command_stats)
+        self.stats_save_button.clicked.connect(self.save_command_stats)
 
         self.column_time_checkbox.stateChanged.connect(
             lambda: self.update_config(
@@ -523,6 +647,16 @@ class MainWindow(QMainWindow):
         self.column_Ig_checkbox.stateChanged.connect(
             lambda: self.update_config("saving.Ig", self.column_Ig_checkbox.isChecked())
         )
+        self.stream_checkbox.stateChanged.connect(
+            lambda: self.update_config(
+                "saving.Stream", self.stream_checkbox.isChecked()
+            )
+        )
+        self.column_host_time_checkbox.stateChanged.connect(
+            lambda: self.update_config(
+                "saving.Host time", self.column_host_time_checkbox.isChecked()
+            )
+        )
 
         self.Y1_combo.currentIndexChanged.connect(self.update_plots)
         self.Y2_combo.currentIndexChanged.connect(self.update_plots)
@@ -541,6 +675,10 @@ class MainWindow(QMainWindow):
         self.Vg_pulse_delay_spin.valueChanged.connect(self.sync_pulse_delay)
 
         self.delay_spin.valueChanged.connect(self.update_sampling_period)
+        self.n_points_spin.valueChanged.connect(self.update_sampling_period)
+        self.profile_combo.currentIndexChanged.connect(self.update_sampling_period)
+        self.Vd_pulse_checkbox.stateChanged.connect(self.update_sampling_period)
+        self.Vg_pulse_checkbox.stateChanged.connect(self.update_sampling_period)
 
         self.show_last_seconds_checkbox.stateChanged.connect(
             lambda: self.show_last_seconds_spin.setEnabled(
@@ -719,14 +857,21 @@ class MainWindow(QMainWindow):
 
     def update_sampling_period(self):
         """
-        Update the sampling period based on the pulse delay
+        Update the sampling period based on the pulse delay: the period must
+        hold the pulse delay, the pulse and the measurement
         """
         if self.Vd_pulse_checkbox.isChecked() or self.Vg_pulse_checkbox.isChecked():
             max_pulse_delay = max(
                 self.Vd_pulse_delay_spin.value(), self.Vg_pulse_delay_spin.value()
             )
-            if self.delay_spin.value() < 2 * max_pulse_delay:
-                self.delay_spin.setValue(2 * max_pulse_delay)
+            profile = SPEED_PROFILES[self.profile_combo.currentText()]
+            min_period = 2 * max_pulse_delay + integration_time(
+                profile["nplc"], self.n_points_spin.value()
+            )
+            # round up to the decimals of the spin box
+            min_period = math.ceil(min_period * 1000) / 1000
+            if self.delay_spin.value() < min_period:
+                self.delay_spin.setValue(min_period)
 
     def set_config(self, cfg):
         """
@@ -813,12 +958,16 @@ class MainWindow(QMainWindow):
         self.X_combo.setCurrentText(cfg["X"]["axis"])
         self.delay_spin.setValue(cfg["period"])
         self.n_points_spin.setValue(cfg["n_points"])
+        self.instrument_sweep_checkbox.setChecked(cfg["instrument_sweep"])
+        self.profile_combo.setCurrentText(cfg["profile"])
 
         self.column_time_checkbox.setChecked(cfg["saving"]["Time"])
         self.column_Vg_checkbox.setChecked(cfg["saving"]["Vg"])
         self.column_Vd_checkbox.setChecked(cfg["saving"]["Vd"])
         self.column_Id_checkbox.setChecked(cfg["saving"]["Id"])
         self.column_Ig_checkbox.setChecked(cfg["saving"]["Ig"])
+        self.column_host_time_checkbox.setChecked(cfg["saving"]["Host time"])
+        self.stream_checkbox.setChecked(cfg["saving"]["Stream"])
 
         if cfg["Vd"]["mode"] == "Sweep":
             for widget in sweep_widgets_vd:
@@ -887,58 +1036,33 @@ class MainWindow(QMainWindow):
         self.start_button.setEnabled(False)
         self.stop_button.setEnabled(True)
 
-        self.points = []
-        modes = [self.Vg_mode_combo.currentText(), self.Vd_mode_combo.currentText()]
-        bi = [
-            self.Vg_bidirectional_checkbox.isChecked(),
-            self.Vd_bidirectional_checkbox.isChecked(),
-        ]
-        values = [self.Vg_spin.value(), self.Vd_spin.value()]
-        ranges = [
-            [self.Vg_start_spin.value(), self.Vg_stop_spin.value()],
-            [self.Vd_start_spin.value(), self.Vd_stop_spin.value()],
-        ]
-        steps = [self.Vg_step_spin.value(), self.Vd_step_spin.value()]
-
-        # Add pulse information
-        pulse_info = []
-        for i, source in enumerate(["Vg", "Vd"]):
-            if (
-                modes[i] == "Fixed"
-                and self.configs[self.mode][source]["fixed"]["pulse"]["enabled"]
-            ):
-                pulse_cfg = self.configs[self.mode][source]["fixed"]["pulse"]
-                pulse_info.append(
-                    {
-                        "enabled": True,
-                        "delta": pulse_cfg["delta"],
-                        "delay": pulse_cfg["delay"],
-                    }
-                )
-            else:
-                pulse_info.append({"enabled": False})
-
-        temp = []
+        settings = measurement_settings(self.configs[self.mode])
+        self.points = settings["points"]
+
+        # Stream the data to a file, keeping only the last samples in memory
+        stream = None
+        max_samples = None
+        if self.stream_checkbox.isChecked():
+            file_name, _ = QFileDialog.getSaveFileName(
+                self,
+                "Stream Data",
+                "",
+                "TSV Files (*.tsv *.csv);;Binary Files (*.bin);;All Files (*)",
+            )
+            if file_name:
+                stream = (file_name, self.saving_columns())
+                max_samples = STREAM_MAX_SAMPLES
 
-        for i, mode in enumerate(modes):
-            if mode == "Sweep":
-                temp.append(np.linspace(ranges[i][0], ranges[i][1], steps[i]))
-                if bi[i]:
-                    temp[-1] = np.concatenate([temp[-1], temp[-1][::-1]])
-            else:
-                temp.append([values[i]])
-
-        for vg in temp[0]:
-            for vd in temp[1]:
-                self.points.append([vg, vd])
-
-        # Pass pulse information to the recorder
-        self.recorder.start(
-            self.points,
-            delay=self.delay_spin.value(),
-            n_points=self.n_points_spin.value(),
-            pulse_info=pulse_info,
-        )
+        try:
+            self.recorder.start(**settings, max_samples=max_samples, stream=stream)
+        except (ValueError, AcquisitionError) as e:
+            self.voltage_group.setEnabled(True)
+            self.start_button.setEnabled(True)
+            self.stop_button.setEnabled(False)
+            self.info_label.setText("Measurement not started")
+            title = "Invalid settings" if isinstance(e, ValueError) else "Error"
+            QMessageBox.warning(self, title, str(e))
+            return
 
         self.info_label.setText("Measurement started")
 
@@ -952,56 +1076,113 @@ class MainWindow(QMainWindow):
         self.start_button.setEnabled(True)
         self.stop_button.setEnabled(False)
 
-        self.info_label.setText("Measurement stopped")
+        # error of the instrument or of the acquisition process
+        error = self.recorder.error
+        scheduler = self.recorder.scheduler
+        if error is not None:
+            self.info_label.setText("Measurement failed")
+            QMessageBox.warning(self, "Measurement failed", str(error))
+        elif scheduler is not None and (scheduler.missed or scheduler.late):
+            self.info_label.setText(
+                f"Measurement stopped ({scheduler.missed} missed periods, "
+                f"{scheduler.late} late samples)"
+            )
+        else:
+            self.info_label.setText("Measurement stopped")
+
+    def refresh(self):
+        """
+        Redraw the plots if new data has been recorded since the last frame
+        """
+        if self.drawn != (self.recorder.data, self.recorder.data.total):
+            self.update_plots()
+
+    def view_changed(self):
+        """
+        Redraw the time series at the next frame when the user zooms or pans
+        """
+        if not self.plot_items[0].vb.state["autoRange"][0]:
+            self.drawn = None
 
     def update_plots(self):
         """
         Update the plot
         """
-        if len(self.recorder.id) != 0:
-            self.id_label.setText(f"Id: {float_to_eng_string(self.recorder.id[-1])}A")
-            self.ig_label.setText(f"Ig: {float_to_eng_string(self.recorder.ig[-1])}A")
-            self.vd_label.setText(f"Vd: {self.recorder.vd[-1]:.2f} V")
-            self.vg_label.setText(f"Vg: {self.recorder.vg[-1]:.2f} V")
-            self.time_label.setText(f"Time: {self.recorder.time[-1]:.2f} s")
+        data = self.recorder.data
+        self.drawn = (data, data.total)
+        time, Id, Ig, Vd, Vg = data.view("Time", "Id", "Ig", "Vd", "Vg")
+
+        if len(Id) != 0:
+            self.id_label.setText(f"Id: {float_to_eng_string(Id[-1])}A")
+            self.ig_label.setText(f"Ig: {float_to_eng_string(Ig[-1])}A")
+            self.vd_label.setText(f"Vd: {Vd[-1]:.2f} V")
+            self.vg_label.setText(f"Vg: {Vg[-1]:.2f} V")
+            self.time_label.setText(f"Time: {time[-1]:.2f} s")
 
         if self.configs[self.mode]["X"]["axis"] == "Time":
-            x = self.recorder.time
+            x = time
         elif self.configs[self.mode]["X"]["axis"] == "Vg":
-            x = self.recorder.vg
+            x = Vg
         else:
-            x = self.recorder.vd
-
-        if self.configs[self.mode]["Y1"]["axis"] == "Id":
-            y1 = self.recorder.id
-        elif self.configs[self.mode]["Y1"]["axis"] == "Ig":
-            y1 = self.recorder.ig
-        elif self.configs[self.mode]["Y1"]["axis"] == "Vd":
-            y1 = self.recorder.vd
-        elif self.configs[self.mode]["Y1"]["axis"] == "Vg":
-            y1 = self.recorder.vg
-        elif self.configs[self.mode]["Y1"]["axis"] == "sqrt(Id)":
-            y1 = np.sqrt(np.abs(self.recorder.id))
-
-        if self.configs[self.mode]["Y2"]["axis"] == "Id":
-            y2 = self.recorder.id
-        elif self.configs[self.mode]["Y2"]["axis"] == "Ig":
-            y2 = self.recorder.ig
-        elif self.configs[self.mode]["Y2"]["axis"] == "Vd":
-            y2 = self.recorder.vd
-        elif self.configs[self.mode]["Y2"]["axis"] == "Vg":
-            y2 = self.recorder.vg
-        elif self.configs[self.mode]["Y2"]["axis"] == "sqrt(Id)":
-            y2 = np.sqrt(np.abs(self.recorder.id))
-
-        if self.show_last_seconds_checkbox.isChecked():
-            mask = np.array(x) >= x[-1] - self.show_last_seconds_spin.value()
-            x = np.array(x)[mask]
-            y1 = np.array(y1)[mask]
-            y2 = np.array(y2)[mask]
-
-        self.curves[0].setData(x, y1)
-        self.curves[1].setData(x, y2)
+            x = Vd
+
+        # sqrt(Id) is computed on the plotted points only
+        series = {"Id": Id, "Ig": Ig, "Vd": Vd, "Vg": Vg, "sqrt(Id)": Id}
+        axes = [
+            self.configs[self.mode]["Y1"]["axis"],
+            self.configs[self.mode]["Y2"]["axis"],
+        ]
+
+        # Time is monotonic: the samples of the last seconds are found by
+        # binary search and plotted as slices, without copies
+        start = 0
+        if self.show_last_seconds_checkbox.isChecked() and len(time) != 0:
+            span = self.show_last_seconds_spin.value()
+            start = int(np.searchsorted(time, time[-1] - span))
+
+        if self.configs[self.mode]["X"]["axis"] == "Time":
+            points = self.time_series(data, time, series, axes, start)
+        else:
+            points = [(x[start:], series[axis][start:]) for axis in axes]
+
+        for i, axis in enumerate(axes):
+            xs, ys = points[i]
+            if axis == "sqrt(Id)":
+                ys = np.sqrt(np.abs(ys))
+            self.curves[i].setData(xs, ys)
+
+    def time_series(self, data, time, series, axes, start=0):
+        """
+        Points of the time series `axes` to draw from the sample `start`: the
+        min and max of the samples falling on each pixel of the visible time
+        range
+        """
+        if self.pyramids_data is not data:
+            self.pyramids = {}
+            self.pyramids_data = data
+        offset = data.total - len(data)
+
+        stop = len(time)
+        view = self.plot_items[0].vb
+        if not view.state["autoRange"][0] and len(time) != 0:
+            # Keep one screen of points on each side for panning
+            t0, t1 = view.viewRange()[0]
+            span = t1 - t0
+            start = max(start, np.searchsorted(time, t0 - span))
+            stop = np.searchsorted(time, t1 + span, side="right")
+        width = max(int(view.width()), 100)
+
+        points = []
+        for axis in axes:
+            y = series[axis]
+            if axis not in self.pyramids:
+                transform = np.abs if axis == "sqrt(Id)" else None
+                self.pyramids[axis] = MinMaxPyramid(transform=transform)
+            pyramid = self.pyramids[axis]
+            pyramid.update(y, offset)
+            idx = pyramid.indices(y, start, stop, width)
+            points.append((time[idx], y[idx]))
+        return points
 
     def save(self):
         """
@@ -1016,21 +1197,103 @@ class MainWindow(QMainWindow):
             options=options,
         )
 
-        columns = [
-            c
-            for c in ["Time", "Vg", "Vd", "Id", "Ig"]
-            if self.configs[self.mode]["saving"].get(c, False)
-        ]
-
         if file_name:
-            self.recorder.save(file_name, columns)
+            self.recorder.save(file_name, self.saving_columns())
             self.info_label.setText("Data saved")
         else:
             self.info_label.setText("Data not saved")
 
+    def saving_columns(self):
+        """
+        Columns selected for saving
+        """
+        return saving_columns(self.configs[self.mode])
+
+    def show_command_stats(self, visible):
+        self.stats_label.setVisible(visible)
+        self.loop_label.setVisible(visible)
+        self.stats_save_button.setVisible(visible)
+        self.stats_table.setVisible(visible)
+        if visible:
+            self.update_command_stats()
+
+    def update_metrics(self):
+        """
+        Update the loop metrics (published by the metrics server) and the
+        command timing panel
+        """
+        if self.metrics_server is None and not self.stats_group.isChecked():
+            return
+        self.metrics = self.recorder.loop_metrics()
+        self.update_command_stats()
+
+    def update_command_stats(self):
+        """
+        Show the latency of the instrument calls of the measurement, per
+        command type, by decreasing total time
+        """
+        if not self.stats_group.isChecked():
+            return
+        stats = self.recorder.command_stats()
+        if stats is None:
+            return
+        commands = sorted(stats["commands"].items(), key=lambda item: -item[1]["total"])
+        total = sum(s["total"] for _, s in commands)
+        self.stats_label.setText(
+            f"{sum(s['count'] for _, s in commands)} calls, "
+            f"{total:.3f} s of I/O in {stats['elapsed']:.3f} s"
+        )
+        self.stats_table.setRowCount(len(commands))
+        for row, (command, s) in enumerate(commands):
+            cells = [
+                command,
+                str(s["count"]),
+                f"{s['total']:.3f}",
+                f"{1e3 * s['mean']:.3f}",
+                f"{1e3 * s['p50']:.3f}",
+                f"{1e3 * s['p99']:.3f}",
+                f"{1e3 * s['max']:.3f}",
+                f"{s['bytes_out']}/{s['bytes_in']}",
+            ]
+            for column, text in enumerate(cells):
+                self.stats_table.setItem(row, column, QTableWidgetItem(text))
+        self.stats_table.resizeColumnToContents(0)
+
+        m = self.metrics
+        if m is not None and m["achieved_rate"] is not None:
+            configured = m["configured_rate"] or 0
+            self.loop_label.setText(
+                f"Rate {m['achieved_rate']:.3g}/{configured:.3g} Hz, "
+                f"jitter p50 {1e3 * m['jitter_p50']:.3g} ms "
+                f"p99 {1e3 * m['jitter_p99']:.3g} ms, "
+                f"sleep {100 * m['sleep_fraction']:.0f}% "
+                f"I/O {100 * m['io_fraction']:.0f}%, "
+                f"backlog {m['backlog']}, "
+                f"buffers {m['buffer_bytes'] / 2**20:.2f} MiB"
+            )
+
+    def save_command_stats(self):
+        """
+        Save the command statistics to a JSON file
+        """
+        file_name, _ = QFileDialog.getSaveFileName(
+            self, "Save Command Timing", "", "JSON Files (*.json);;All Files (*)"
+        )
+        stats = self.recorder.command_stats()
+        if file_name and stats is not None:
+            with open(file_name, "w") as f:
+                json.dump(stats, f, indent=4)
+            self.info_label.setText("Command timing saved")
+
     def closeEvent(self, event):
         """
         Close the application
         """
+        # no refresh or metrics request once the recorder is closed
+        self.frame_timer.stop()
+        self.stats_timer.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
         self.recorder.stop()
+        self.recorder.close()
         event.accept()
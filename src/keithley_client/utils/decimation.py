@@ -0,0 +1,156 @@
+import numpy as np
+
+
+class MinMaxPyramid:
+    """
+    Multi-resolution min/max index of a growing series, to plot only the
+    points that can be seen
+
+    Level k holds, for every block of `base * 2**k` samples, the index of its
+    minimum and of its maximum. The indices are absolute sample numbers and
+    the blocks are aligned on them, so that the levels are updated
+    incrementally with the samples added since the last update, also when
+    the series is a ring buffer dropping its oldest samples: the blocks
+    reaching the dropped samples are removed from the start of each level.
+
+    transform: function applied to the samples before comparing them (e.g.
+    np.abs to plot sqrt(|Id|))
+    """
+
+    def __init__(self, base=8, transform=None):
+        self.base = base
+        self.transform = transform
+        self.reset()
+
+    def reset(self, offset=0):
+        # offset: absolute number of the first sample of the series
+        self.offset = offset
+        # end: absolute number of the first sample not indexed by level 0
+        self.end = -(-offset // self.base) * self.base
+        # levels: (first block number, min indices, max indices)
+        self.levels = []
+
+    def values(self, y, start, stop):
+        v = y[start:stop]
+        return v if self.transform is None else self.transform(v)
+
+    def values_at(self, y, idx):
+        v = y[idx - self.offset]
+        return v if self.transform is None else self.transform(v)
+
+    def update(self, y, offset=0):
+        """
+        Index the samples of `y` added since the last update
+
+        offset: number of samples dropped at the start of the series (ring
+        buffers), the blocks reaching them are dropped
+        """
+        if offset < self.offset or offset + len(y) < self.end:
+            # a new series
+            self.reset(offset)
+        elif offset > self.offset:
+            self.drop(offset)
+
+        n_blocks = (offset + len(y)) // self.base
+        done = self.end // self.base
+        if n_blocks > done:
+            v = self.values(y, done * self.base - offset, n_blocks * self.base - offset)
+            v = v.reshape(-1, self.base)
+            first = done * self.base + np.arange(len(v)) * self.base
+            self.append(0, done, first + v.argmin(axis=1), first + v.argmax(axis=1))
+            self.end = n_blocks * self.base
+
+            # merge pairs of blocks into the upper levels
+            level = 0
+            while True:
+                first, imin, imax = self.levels[level]
+                n_upper = (first + len(imin)) // 2
+                if len(self.levels) == level + 1:
+                    if n_upper <= -(-first // 2):
+                        break
+                    self.levels.append((-(-first // 2), imin[:0], imax[:0]))
+                upper_first, upper_min, _ = self.levels[level + 1]
+                done = upper_first + len(upper_min)
+                if n_upper <= done:
+                    break
+                a = slice(2 * done - first, 2 * n_upper - first, 2)
+                b = slice(2 * done + 1 - first, 2 * n_upper - first, 2)
+                va = self.values_at(y, imin[a])
+                vb = self.values_at(y, imin[b])
+                new_min = np.where(va <= vb, imin[a], imin[b])
+                va = self.values_at(y, imax[a])
+                vb = self.values_at(y, imax[b])
+                new_max = np.where(va >= vb, imax[a], imax[b])
+                self.append(level + 1, done, new_min, new_max)
+                level += 1
+
+    def drop(self, offset):
+        """
+        Drop the blocks reaching the samples before `offset`
+        """
+        self.offset = offset
+        for level, (first, imin, imax) in enumerate(self.levels):
+            size = self.base << level
+            new_first = -(-offset // size)
+            cut = new_first - first
+            if cut > 0:
+                self.levels[level] = (new_first, imin[cut:], imax[cut:])
+        self.end = max(self.end, -(-offset // self.base) * self.base)
+
+    def append(self, level, block, imin, imax):
+        """
+        Append the blocks from the number `block` to `level`
+        """
+        if len(self.levels) == level:
+            self.levels.append((block, imin, imax))
+        else:
+            first, old_min, old_max = self.levels[level]
+            if first + len(old_min) != block:
+                # the level was emptied by drop before reaching `block`
+                first, old_min, old_max = block, old_min[:0], old_max[:0]
+            self.levels[level] = (
+                first,
+                np.concatenate([old_min, imin]),
+                np.concatenate([old_max, imax]),
+            )
+
+    def indices(self, y, start, stop, width):
+        """
+        Indices of the samples to plot for the range [start, stop) of `y` on
+        `width` pixels: the min and max of each block of the coarsest level
+        with at least `width` blocks in the range, and of the partial blocks
+        at the edges
+        """
+        start = max(start, 0)
+        stop = min(stop, len(y))
+        if stop - start <= 2 * width or not self.levels:
+            return np.arange(start, stop)
+
+        level = 0
+        while (
+            level + 1 < len(self.levels)
+            and (stop - start) // (self.base << (level + 1)) >= width
+        ):
+            level += 1
+        size = self.base << level
+        first, imin, imax = self.levels[level]
+        # absolute block numbers of the blocks inside the range
+        b0 = max(-(-(start + self.offset) // size), first)
+        b1 = min((stop + self.offset) // size, first + len(imin))
+        if b1 <= b0:
+            return np.arange(start, stop)
+
+        blocks = slice(b0 - first, b1 - first)
+        parts = [
+            np.sort(np.stack([imin[blocks], imax[blocks]], axis=1), axis=1)
+            - self.offset
+        ]
+        for lo, hi in [
+            (start, b0 * size - self.offset),
+            (b1 * size - self.offset, stop),
+        ]:
+            if hi > lo:
+                v = self.values(y, lo, hi)
+                edge = np.sort([lo + v.argmin(), lo + v.argmax()])
+                parts.append(edge.reshape(1, 2))
+        return np.unique(np.concatenate([p.ravel() for p in parts]))